@@ -0,0 +1,59 @@
+"""Throughput of MarkdownV2/HTML escaping against the original chained str.replace versions
+
+Run from the repository root: python benchmarks/bench_escape.py
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xhsfeedbot import make_block_quotation, tg_msg_escape_html, tg_msg_escape_markdown_v2
+
+def old_escape_markdown_v2(t: str | int) -> str:
+    t = str(t)
+    for i in ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']:
+        t = t.replace(i, "\\" + i)
+    return t
+
+def old_escape_html(t: str) -> str:
+    return t.replace('<', '&lt;').replace('>', '&gt;').replace('&', '&amp;')
+
+def old_make_block_quotation(text: str) -> str:
+    lines = [f'>{old_escape_markdown_v2(line)}' for line in text.split('\n') if len(line) > 0 and bool(re.findall(r'\S+', line))]
+    if len(lines) > 3:
+        lines[0] = f'**{lines[0]}'
+        lines[-1] = f'{lines[-1]}||'
+    return '\n'.join(lines)
+
+def comment_corpus(count: int = 20000) -> list[str]:
+    """Comment-like text, mostly CJK with some punctuation that needs escaping"""
+    rng = random.Random(4)
+    cjk = [chr(rng.randint(0x4e00, 0x9fff)) for _ in range(500)]
+    return [
+        ''.join(rng.choice(cjk) if rng.random() > .04 else rng.choice('.!()#-\n&<') for _ in range(rng.randint(5, 120)))
+        for _ in range(count)
+    ]
+
+def short_fields(count: int = 20000) -> list[str]:
+    """Nicknames, locations and timestamps"""
+    return (['张三', '上海', '2024-01-01 12:00:00', '1234', 'nick_name'] * count)[:count]
+
+def measure(f, texts: list[str]) -> float:
+    start = time.perf_counter()
+    for text in texts:
+        f(text)
+    return len(texts) / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    cases = [
+        ('markdown_v2', old_escape_markdown_v2, tg_msg_escape_markdown_v2),
+        ('html', old_escape_html, tg_msg_escape_html),
+        ('block quotation', old_make_block_quotation, make_block_quotation),
+    ]
+    for corpus_name, texts in (('comments', comment_corpus()), ('short fields', short_fields())):
+        print(corpus_name)
+        for name, old, new in cases:
+            print(f'  {name:16} old {measure(old, texts) / 1e3:7.0f}k/s  new {measure(new, texts) / 1e3:7.0f}k/s')
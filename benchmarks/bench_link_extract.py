@@ -0,0 +1,123 @@
+"""Note link extraction from long pasted messages, get_url_info against the original URL_REGEX version
+
+Redirects are answered locally and the short-link cache is bypassed, so only the parsing is timed.
+
+Run from the repository root: python benchmarks/bench_link_extract.py
+"""
+import asyncio
+import logging
+import os
+import re
+import sys
+import time
+from urllib.parse import parse_qs, unquote, urljoin, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xhsfeedbot
+from xhsfeedbot import bot_logger, get_url_info
+
+URL_REGEX = r"""(?i)\b((?:https?:(?:/{1,3}|[a-z0-9%])|[a-z0-9.\-]+[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)/)(?:[^\s()<>{}\[\]]+|\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\))+(?:\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\)|[^\s`!()\[\]{};:\'\".,<>?«»“”‘’])|(?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\b/?(?!@)))"""
+
+REDIRECT = 'https://www.xiaohongshu.com/discovery/item/68a1b2c3d4e5f60718293a4b?xsec_token=ABx-Yz=&anchorCommentId=68aa00000000000000000001'
+
+def old_get_redirected_url(url: str) -> str:
+    return REDIRECT
+
+def get_clean_url(url: str) -> str:
+    return urljoin(url, urlparse(url).path)
+
+def old_get_url_info(message_text: str) -> dict[str, str | bool]:
+    xsec_token = ''
+    urls = re.findall(URL_REGEX, message_text)
+    anchorCommentId = ''
+    if len(urls) == 0:
+        bot_logger.debug("NO URL FOUND!")
+        return {'success': False, 'msg': 'No URL found in the message.', 'noteId': '', 'xsec_token': '', 'anchorCommentId': ''}
+    elif re.findall(r"[a-z0-9]{24}", message_text) and not re.findall(r"user/profile/[a-z0-9]{24}", message_text):
+        noteId = re.findall(r"[a-z0-9]{24}", message_text)[0]
+        note_url = [u for u in urls if re.findall(r"[a-z0-9]{24}", u) and not re.findall(r"user/profile/[a-z0-9]{24}", u)][0]
+        parsed_url = urlparse(str(note_url))
+        if 'xsec_token' in parse_qs(parsed_url.query):
+            xsec_token = parse_qs(parsed_url.query)['xsec_token'][0]
+        if 'anchorCommentId' in parse_qs(parsed_url.query):
+            anchorCommentId = parse_qs(parsed_url.query)['anchorCommentId'][0]
+    elif 'xhslink.com' in message_text or 'xiaohongshu.com' in message_text:
+        xhslink = [u for u in urls if 'xhslink.com' in u][0]
+        bot_logger.debug(f"URL found: {xhslink}")
+        redirectPath = old_get_redirected_url(xhslink)
+        bot_logger.debug(f"Redirected URL: {redirectPath}")
+        if re.findall(r"https?://(?:www.)?xhslink.com/[a-z]/[A-Za-z0-9]+", xhslink):
+            clean_url = get_clean_url(redirectPath)
+            if 'xiaohongshu.com/404' in redirectPath or 'xiaohongshu.com/login' in redirectPath:
+                noteId = re.findall(r"noteId=([a-z0-9]+)", redirectPath)[0]
+                if 'redirectPath=' in redirectPath:
+                    redirectPath = unquote(redirectPath.replace('https://www.xiaohongshu.com/login?redirectPath=', '').replace('https://www.xiaohongshu.com/404?redirectPath=', '').replace('https://www.xiaohongshu.com/login?redirectPath=', ''))
+            else:
+                noteId = re.findall(r"https?:\/\/(?:www.)?xiaohongshu.com\/discovery\/item\/([a-z0-9]+)", clean_url)[0]
+            parsed_url = urlparse(str(redirectPath))
+            if 'xsec_token' in parse_qs(parsed_url.query):
+                xsec_token = parse_qs(parsed_url.query)['xsec_token'][0]
+            if 'anchorCommentId' in parse_qs(parsed_url.query):
+                anchorCommentId = parse_qs(parsed_url.query)['anchorCommentId'][0]
+        elif re.findall(r"https?:\/\/(?:www.)?xiaohongshu.com\/discovery\/item\/[0-9a-z]+", xhslink):
+            noteId = re.findall(r"https?:\/\/(?:www.)?xiaohongshu.com\/discovery\/item\/([a-z0-9]+)", xhslink)[0]
+            parsed_url = urlparse(str(xhslink))
+            if 'xsec_token' in parse_qs(parsed_url.query):
+                xsec_token = parse_qs(parsed_url.query)['xsec_token'][0]
+            if 'anchorCommentId' in parse_qs(parsed_url.query):
+                anchorCommentId = parse_qs(parsed_url.query)['anchorCommentId'][0]
+        elif re.findall(r"https?://(?:www.)?xiaohongshu.com/explore/[a-z0-9]+", message_text):
+            noteId = re.findall(r"https?:\/\/(?:www.)?xiaohongshu.com\/explore\/([a-z0-9]+)", xhslink)[0]
+            parsed_url = urlparse(str(xhslink))
+            if 'xsec_token' in parse_qs(parsed_url.query):
+                xsec_token = parse_qs(parsed_url.query)['xsec_token'][0]
+            if 'anchorCommentId' in parse_qs(parsed_url.query):
+                anchorCommentId = parse_qs(parsed_url.query)['anchorCommentId'][0]
+        else:
+            return {'success': False, 'msg': 'Invalid URL or the note is no longer available.', 'noteId': '', 'xsec_token': ''}
+    else:
+        return {'success': False, 'msg': 'Invalid URL.', 'noteId': '', 'xsec_token': ''}
+    return {'success': True, 'msg': 'Success.', 'noteId': noteId, 'xsec_token': xsec_token, 'anchorCommentId': anchorCommentId}
+
+async def get_redirected_url(url: str, max_hops: int = 5) -> str:
+    return REDIRECT
+
+class NoCache:
+    async def get(self, key: str) -> None:
+        return None
+
+    def set(self, key: str, value: object) -> None:
+        pass
+
+NOTE_ID = '68a1b2c3d4e5f60718293a4b'
+FILLER = '这篇笔记真的太好看了，快来看看吧！😂 ' * 40 + 'see https://example.com/foo and www.google.com/search?q=x '
+MESSAGES = {
+    'full link': f'{FILLER} https://www.xiaohongshu.com/discovery/item/{NOTE_ID}?source=webshare&xsec_token=CBabc_-XYZ=&xsec_source=pc_share {FILLER}',
+    'explore + anchor': f'{FILLER}https://www.xiaohongshu.com/explore/{NOTE_ID}?anchorCommentId=68aa00000000000000000001&xsec_token=ZZ {FILLER}',
+    'share text + short link': f'55 【标题】 {FILLER} http://xhslink.com/a/AbCdEf123，复制本条信息，打开【小红书】App查看精彩内容！',
+    'no link': FILLER * 2,
+}
+FIELDS = ('success', 'noteId', 'xsec_token', 'anchorCommentId')
+
+async def main() -> None:
+    bot_logger.setLevel(logging.WARNING)
+    xhsfeedbot.get_redirected_url = get_redirected_url
+    xhsfeedbot.short_links = NoCache()  # type: ignore
+    rounds = 200
+    for name, message in MESSAGES.items():
+        old_result, new_result = old_get_url_info(message), await get_url_info(message)
+        # The original left anchorCommentId out of failed results
+        assert {k: old_result.get(k, '') for k in FIELDS} == {k: new_result.get(k, '') for k in FIELDS}, (name, old_result, new_result)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            old_get_url_info(message)
+        old = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await get_url_info(message)
+        new = (time.perf_counter() - start) / rounds
+        print(f'{name:25} {len(message):5} chars  old {old * 1e6:8.1f} us  new {new * 1e6:6.1f} us')
+
+if __name__ == '__main__':
+    asyncio.run(main())
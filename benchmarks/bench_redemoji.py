@@ -0,0 +1,43 @@
+"""RED emoji replacement on comment-heavy notes, the [...R] token regex against the original per-entry str.replace loop
+
+The original ran once per text in to_html, __str__ and the comment sender, the new one runs once in parse_comment.
+
+Run from the repository root: python benchmarks/bench_redemoji.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xhsfeedbot import redtoemoji, replace_redemoji_with_emoji
+
+def old_replace_redemoji_with_emoji(text: str) -> str:
+    for red_emoji, emoji in redtoemoji.items():
+        text = text.replace(red_emoji, emoji)
+    return text
+
+def comment_texts(count: int = 20000) -> list[str]:
+    """Comments with known and unknown tokens, hashtags and stray brackets, plus plain ones"""
+    rng = random.Random(2)
+    tokens = list(redtoemoji)
+    texts = [
+        ''.join(rng.choice(['好看', '哈哈哈', rng.choice(tokens), ' ', 'abc', '[不存在R]', '#话题[话题]#', '[']) for _ in range(rng.randint(1, 30)))
+        for _ in range(count)
+    ]
+    return texts + ['纯文本评论没有表情' * 3] * (count // 4)
+
+if __name__ == '__main__':
+    texts = comment_texts()
+    assert all(old_replace_redemoji_with_emoji(t) == replace_redemoji_with_emoji(t) for t in texts), 'outputs differ'
+    print(f'identical on {len(texts)} texts')
+    timings: dict[str, float] = {}
+    for name, f in (('old', old_replace_redemoji_with_emoji), ('new', replace_redemoji_with_emoji)):
+        start = time.perf_counter()
+        for text in texts:
+            f(text)
+        timings[name] = (time.perf_counter() - start) / len(texts)
+        print(f'{name}: {timings[name] * 1e6:.2f} us/text')
+    # A note with 1000 comments and replies, three passes per text before, one now
+    print(f'1000 texts per note: old {timings["old"] * 3 * 1000 * 1e3:.1f} ms, new {timings["new"] * 1000 * 1e3:.1f} ms')
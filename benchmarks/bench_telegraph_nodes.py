@@ -0,0 +1,139 @@
+"""Telegraph page rendering on comment-heavy notes, Note.to_nodes against the original HTML string build
+
+The original built HTML with f-string concatenation and the telegraph library parsed it back into nodes
+before create_page, both steps are timed together.
+
+Run from the repository root: python benchmarks/bench_telegraph_nodes.py
+"""
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegraph.utils import html_to_nodes
+
+from xhsfeedbot import Note, bot_logger, convert_timestamp_to_timestr, get_time_emoji, replace_redemoji_with_emoji, tg_msg_escape_html
+
+def old_to_html(self: Note) -> str:
+    html = ''
+    html += f'<h3><a href="{self.url}">{self.title}</a></h3>' if self.title else ''
+    for img in self.images_list:
+        if not img['live']:
+            html += f'<img src="{img["url"]}"></img>'
+        else:
+            html += f'<video src="{img["url"]}"></video>'
+    if self.video_url:
+        html += f'<video src="{self.video_url}"></video>'
+    for lines in self.desc.split('\n'):
+        line_html = tg_msg_escape_html(lines)
+        html += f'<blockquote>{line_html}</blockquote>'
+    html += f'<h4>👤 <a href="https://www.xiaohongshu.com/user/profile/{self.user["id"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""}"> @{self.user["name"]} ({self.user.get("red_id", "")})</a></h4>'
+    html += f'<img src="{self.user["image"]}"></img>'
+    html += f'<p>{get_time_emoji(self.time)} {convert_timestamp_to_timestr(self.time)}</p>'
+    html += f'<p>❤️ {self.liked_count} ⭐ {self.collected_count} 💬 {self.comments_count} 🔗 {self.shared_count}</p>'
+    if hasattr(self, 'ip_location'):
+        ipaddr_html = tg_msg_escape_html(self.ip_location)
+    else:
+        ipaddr_html = '?'
+    html += f'<p>📍 {ipaddr_html}</p>'
+    html += f'<blockquote><a href="{self.url}">Source</a></blockquote>'
+    if self.comments:
+        html += '<hr>'
+        for i, comment in enumerate(self.comments):
+            html += f'<h4>💬 <a href="https://www.xiaohongshu.com/discovery/item/{self.noteId}?anchorCommentId={comment["id"]}{f"&xsec_token={self.xsec_token}" if self.with_xsec_token else ""}">Comment</a></h4>'
+            if 'target_comment' in comment:
+                html += f'<p>↪️ <a href="https://www.xiaohongshu.com/user/profile/{comment["target_comment"]["user"]["userid"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""}"> {'@' + comment["target_comment"]["user"].get("nickname", "")} ({comment["target_comment"]["user"].get('red_id', '')})</a></p>'
+            html += f'<p>{tg_msg_escape_html(replace_redemoji_with_emoji(comment["content"]))}</p>'
+            for pic in comment['pictures']:
+                if 'mp4' in pic:
+                    html += f'<video src="{pic}"></video>'
+                else:
+                    html += f'<img src="{pic}"></img>'
+            if comment.get('audio_url', ''):
+                html += f'<p><a href="{comment["audio_url"]}">🎤 Voice</a></p>'
+            html += f'<p>❤️ {comment["like_count"]} 💬 {comment["sub_comment_count"]}<br>📍 {tg_msg_escape_html(comment["ip_location"])}<br>{get_time_emoji(comment["time"])} {convert_timestamp_to_timestr(comment["time"])}</p>'
+            html += f'<p>👤 <a href="https://www.xiaohongshu.com/user/profile/{comment["user"]["userid"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""}"> {'@' + comment["user"].get("nickname", "")} ({comment["user"].get("red_id", "")})</a></p>'
+            for sub_comment in comment.get('sub_comments', []):
+                html += '<blockquote><blockquote>'
+                html += f'<h4>💬 <a href="https://www.xiaohongshu.com/discovery/item/{self.noteId}?anchorCommentId={sub_comment["id"]}{f"&xsec_token={self.xsec_token}" if self.with_xsec_token else ""}">Comment</a></h4>'
+                if 'target_comment' in sub_comment:
+                    html += f'<br><p>  ↪️  <a href="https://www.xiaohongshu.com/user/profile/{sub_comment["target_comment"]["user"]["userid"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""}"> {'@' + sub_comment["target_comment"]["user"].get("nickname", "")} ({sub_comment["target_comment"]["user"].get("red_id", "")})</a></p>'
+                html += f'<br><p>{tg_msg_escape_html(replace_redemoji_with_emoji(sub_comment["content"]))}</p>'
+                for pic in sub_comment['pictures']:
+                    if 'mp4' in pic:
+                        html += f'<br><video src="{pic}"></video>'
+                    else:
+                        html += f'<br><img src="{pic}"></img>'
+                if sub_comment.get('audio_url', ''):
+                    html += f'<br><p><a href="{sub_comment["audio_url"]}">🎤 Voice</a></p>'
+                html += f'<br><p>❤️ {sub_comment["like_count"]} 💬 {sub_comment["sub_comment_count"]}<br>📍 {tg_msg_escape_html(sub_comment["ip_location"])}<br>{get_time_emoji(sub_comment["time"])} {convert_timestamp_to_timestr(sub_comment["time"])}</p>'
+                html += f'<br><p>👤 <a href="https://www.xiaohongshu.com/user/profile/{sub_comment["user"]["userid"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""}"> {'@' + sub_comment["user"].get("nickname", "")} ({sub_comment["user"].get("red_id", "")})</a></p>'
+                html += '</blockquote></blockquote>'
+            if i != len(self.comments) - 1:
+                html += f'<hr>'
+    return html
+
+rng = random.Random(1)
+# No markup: the original did not escape titles or nicknames, so it cannot render them
+WORDS = ['你好', 'hello', 'world  ', '\n', '😂', 'foo', 'bar baz', '  ', 'x']
+
+def text(n: int = 8) -> str:
+    return ''.join(rng.choice(WORDS) for _ in range(rng.randint(0, n)))
+
+def user() -> dict[str, str]:
+    return {'userid': f'u{rng.randint(0, 99)}', 'nickname': text(3), 'red_id': str(rng.randint(0, 9999))}
+
+def comment(with_replies: bool = True) -> dict:
+    c = {
+        'id': f'c{rng.randint(0, 10**9)}', 'content': text(20), 'like_count': rng.randint(0, 99), 'sub_comment_count': 0,
+        'ip_location': rng.choice(['上海', '', 'a b']), 'time': rng.randint(0, 2 * 10**9), 'user': user(),
+        'pictures': [rng.choice(['http://p/a.jpg', 'http://p/v.mp4']) for _ in range(rng.choice([0, 0, 1, 3]))],
+    }
+    if rng.random() < .2:
+        c['audio_url'] = 'http://a/v.m4a'
+    if rng.random() < .3:
+        c['target_comment'] = {'user': user()}
+    if with_replies:
+        c['sub_comments'] = [comment(False) for _ in range(rng.choice([0, 0, 1, 4]))]
+    return c
+
+class SyntheticNote(Note):
+    """Only the fields the page renderers read"""
+    def __init__(self, comment_count: int) -> None:
+        self.title = 'T  itle ' + text(2)
+        self.noteId = 'a' * 24
+        self.url = f'https://www.xiaohongshu.com/discovery/item/{self.noteId}'
+        self.images_list = [{'live': '', 'url': 'http://i/1'}, {'live': 'True', 'url': 'http://i/2.mp4'}]
+        self.video_url = ''
+        self.desc = text(40)
+        self.user = {'id': 'u', 'name': 'N ame', 'red_id': '1', 'image': 'http://u'}
+        self.time = 1700000000
+        self.liked_count = self.collected_count = self.comments_count = self.shared_count = 1
+        self.ip_location = '北京'
+        self.with_xsec_token = rng.random() < .5
+        self.xsec_token = 'tok'
+        self.comments = [comment() for _ in range(comment_count)]
+
+if __name__ == '__main__':
+    bot_logger.setLevel(logging.INFO)
+    for comment_count in (0, 5, 50):
+        for _ in range(20):
+            note = SyntheticNote(comment_count)
+            assert html_to_nodes(old_to_html(note)) == note.to_nodes(), 'node trees differ'
+    print('node trees identical to the parsed HTML')
+    for comment_count in (1000, 2000):
+        note = SyntheticNote(comment_count)
+        total = comment_count + sum(len(c['sub_comments']) for c in note.comments)
+        start = time.perf_counter()
+        for _ in range(3):
+            json.dumps(html_to_nodes(old_to_html(note)), ensure_ascii=False)
+        old = (time.perf_counter() - start) / 3
+        start = time.perf_counter()
+        for _ in range(3):
+            json.dumps(note.to_nodes(), ensure_ascii=False)
+        new = (time.perf_counter() - start) / 3
+        print(f'{comment_count} comments ({total} with replies): HTML + parse {old * 1000:.0f} ms, nodes {new * 1000:.0f} ms')
@@ -0,0 +1,69 @@
+"""Per-URL cost of URLClassifier against the original ImageFeedFilter, CommentListFilter and BlockURLs scans
+
+Run from the repository root: python benchmarks/bench_url_classifier.py
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mitm_server import URLClassifier, get_block_pattern_list, get_capture_pattern_list
+
+# Feed, media and telemetry traffic seen while a device opens notes
+URLS = [
+    'https://edith.xiaohongshu.com/api/sns/v10/note/imagefeed?note_id=66aa00000000000000000000&x=1',
+    'https://edith.xiaohongshu.com/api/sns/v5/note/comment/list?note_id=66aa00000000000000000000&num=10',
+    'https://edith.xiaohongshu.com/api/sns/v6/homefeed?oid=homefeed_recommend&cursor_score=&geo=abc',
+    'https://edith.xiaohongshu.com/api/sns/v1/system_service/config?a=1',
+    'https://edith.xiaohongshu.com/api/sns/v2/note/metrics_report',
+    'https://sns-na-i6.xhscdn.com/1040g00831abc?imageView2/2/w/1080/format/webp',
+    'https://sns-webpic-qc.xhscdn.com/202410/abcdef/1040g2sg31?imageView2/2/w/540/format/heif',
+    'https://sns-video-bd.xhscdn.com/stream/110/258/01e6abc_258.mp4',
+    'https://apm-native.xiaohongshu.com/api/collect?b=1',
+    'https://t2.xiaohongshu.com/api/collect',
+    'https://infra-app-log-1251524319.cos.ap-shanghai.myqcloud.com/xhslog/abc',
+    'https://sns-avatar-qc.xhscdn.com/avatar/1040g2jo31?imageView2/2/w/80/format/jpg',
+    'https://www.xiaohongshu.com/api/sns/v1/hey/feed',
+    'https://gslb.xiaohongshu.com/api/gslb/v1/domainNew?x=1',
+    'https://ci.xiaohongshu.com/icons/user/abc.png',
+    'https://mall.xiaohongshu.com/api/store/guide/components/shop_entrance?id=1',
+    'https://edith.xiaohongshu.com/api/sns/v1/user/me',
+    'https://www.google.com/generate_204',
+    'https://fe-video-qc.xhscdn.com/fe-platform/abc.mp4',
+    'https://spider-tracker.xiaohongshu.com/api/spider?x=1',
+    # The note pattern is https only, the comment list and block patterns take either scheme
+    'http://edith.xiaohongshu.com/api/sns/v10/note/imagefeed?note_id=66aa00000000000000000000&x=1',
+    'http://edith.xiaohongshu.com/api/sns/v5/note/comment/list?note_id=66aa00000000000000000000&num=10',
+    'http://apm-native.xiaohongshu.com/api/collect?b=1',
+]
+
+capture_patterns = get_capture_pattern_list()
+block_pattern_list = get_block_pattern_list()
+note_pattern = re.compile(capture_patterns[URLClassifier.NOTE])
+comment_list_pattern = re.compile(capture_patterns[URLClassifier.COMMENT_LIST])
+
+def old_classify(url: str) -> str:
+    """What the three original addons did, each of them ran on every flow"""
+    note = bool(re.findall(note_pattern, url))
+    comment_list = bool(re.findall(comment_list_pattern, url))
+    blocked = bool([True for pattern in block_pattern_list if re.findall(pattern, url)])
+    if note:
+        return URLClassifier.NOTE
+    if comment_list:
+        return URLClassifier.COMMENT_LIST
+    return URLClassifier.BLOCK if blocked else URLClassifier.PASS
+
+if __name__ == '__main__':
+    classifier = URLClassifier(capture_patterns, block_pattern_list)
+    for url in URLS:
+        assert old_classify(url) == classifier.classify(url)[0], url
+    rng = random.Random(1)
+    mix = [rng.choice(URLS) for _ in range(20000)]
+    for name, classify in (('original addons', old_classify), ('URLClassifier', lambda url: classifier.classify(url)[0])):
+        start = time.perf_counter()
+        for url in mix:
+            classify(url)
+        print(f'{name:16} {(time.perf_counter() - start) / len(mix) * 1e6:6.2f} us/url')
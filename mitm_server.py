@@ -1,5 +1,10 @@
 import re
+import time
+import queue
+import logging
+import threading
 import requests
+from collections import Counter
 from mitmproxy.tools.main import mitmdump # type: ignore
 from mitmproxy import http, ctx
 from urllib.parse import parse_qs, urlparse
@@ -10,75 +15,168 @@ load_dotenv()
 FLASK_SERVER_NAME = '127.0.0.1'
 FLASK_SERVER_PORT = os.getenv('FLASK_SERVER_PORT', '5001')
 
-def set_request(note_id:str, url: str, data: dict[str, Any], type: str) -> dict[str, Any]:
-    requests.post(
-        f"http://{FLASK_SERVER_NAME}:{FLASK_SERVER_PORT}/set_{type}",
-        json={"note_id": note_id, "url": url, "data": data}
-    )
-    return {"note_id": note_id, "url": url, "data": data}
+class CaptureSender:
+    """Posts captures to the relay from a background thread, so the proxy hooks never wait on the relay"""
+    def __init__(self, max_queue: int = 64, retries: int = 3):
+        self.queue: queue.Queue[dict[str, Any]] = queue.Queue(maxsize=max_queue)
+        self.session = requests.Session()  # Keep-alive connection to the relay
+        self.retries = retries
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
-class ImageFeedFilter:
-    def __init__(self, callback: Any):
-        self.callback = callback
-        self.url_pattern = re.compile(r"https://edith.xiaohongshu.com/api/sns/v\d+/note/imagefeed")
-        self.type = 'note'
+    def __call__(self, note_id: str, url: str, data: dict[str, Any], type: str, client_ip: str = '') -> dict[str, Any]:
+        capture = {"note_id": note_id, "url": url, "data": data, "client_ip": client_ip, "type": type}
+        try:
+            self.queue.put_nowait(capture)
+        except queue.Full:
+            self.dropped += 1
+            logging.warning(f"Capture queue full, dropped {type} of {note_id} ({self.stats()})")
+        return capture
 
-    def get_note_id(self, url: str) -> str:
-        parsed_url = urlparse(url)
-        query_params = parse_qs(parsed_url.query)
-        note_id = query_params.get('note_id', [None])[0]
-        if note_id is None:
-            raise ValueError("note_id not found in URL")
-        return note_id
+    def run(self) -> None:
+        while True:
+            capture = self.queue.get()
+            capture_type = capture.pop("type")
+            for attempt in range(self.retries):
+                try:
+                    self.session.post(
+                        f"http://{FLASK_SERVER_NAME}:{FLASK_SERVER_PORT}/set_{capture_type}",
+                        json=capture,
+                        timeout=10
+                    ).raise_for_status()
+                    self.sent += 1
+                    logging.info(f"Capture sent: {capture_type} of {capture['note_id']} ({self.stats()})")
+                    break
+                except requests.RequestException as e:
+                    logging.warning(f"Failed to send {capture_type} of {capture['note_id']}, attempt {attempt + 1}: {e}")
+                    # No backoff after the last attempt, the queue behind it is waiting
+                    if attempt + 1 < self.retries:
+                        time.sleep(0.5 * 2 ** attempt)
+            else:
+                self.failed += 1
+                logging.error(f"Dropped {capture_type} of {capture['note_id']} after {self.retries} attempts ({self.stats()})")
+            self.queue.task_done()
 
-    def response(self, flow: http.HTTPFlow) -> None:
-        if re.findall(self.url_pattern, flow.request.pretty_url):
-            data = flow.response
-            if data is not None:
-                json_data = data.json()
+    def stats(self) -> str:
+        return f"queue depth {self.queue.qsize()}, sent {self.sent}, dropped {self.dropped}, failed {self.failed}"
+
+    def done(self) -> None:
+        # Give pending captures a moment to reach the relay on shutdown
+        deadline = time.monotonic() + 5
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+def get_note_id(url: str) -> str:
+    parsed_url = urlparse(url)
+    query_params = parse_qs(parsed_url.query)
+    note_id = query_params.get('note_id', [None])[0]
+    if note_id is None:
+        raise ValueError("note_id not found in URL")
+    return note_id
+
+class URLClassifier:
+    """Classify a URL in a single pass as a note capture, comment list capture, blocked or passed
+
+    Patterns with a literal host are indexed by scheme and host, each gets one compiled alternation
+    of its paths. Patterns with a wildcard host are combined into one alternation over the URL.
+    """
+    NOTE = 'note'
+    COMMENT_LIST = 'comment_list'
+    BLOCK = 'block'
+    PASS = 'pass'
+
+    def __init__(self, capture_patterns: dict[str, str], block_pattern_list: list[str]):
+        # Capture rules come first so they win over a block rule for the same URL
+        self.rules: list[tuple[str, str]] = list(capture_patterns.items()) + [(self.BLOCK, pattern) for pattern in dict.fromkeys(block_pattern_list)]
+        host_alternatives: dict[str, list[str]] = {}
+        wildcard_alternatives: list[str] = []
+        for i, (_, pattern) in enumerate(self.rules):
+            scheme, _, rest = pattern.partition('://')
+            host, slash, path = rest.partition('/')
+            if scheme in ('https?', 'https', 'http') and re.fullmatch(r'[A-Za-z0-9.\-]+', host):
+                # 'https?' is indexed under both schemes, 'https' only under https like the pattern it came from
+                for each_scheme in (('http', 'https') if scheme == 'https?' else (scheme,)):
+                    host_alternatives.setdefault(f'{each_scheme}://{host.lower()}', []).append(f'(?P<r{i}>{slash}{path})')
             else:
-                json_data = {}
-            self.callback(
-                note_id=self.get_note_id(flow.request.pretty_url),
-                url=flow.request.pretty_url,
-                data=json_data,
-                type=self.type
-            )
+                wildcard_alternatives.append(f'(?P<r{i}>{pattern})')
+        self.host_table: dict[str, re.Pattern[str]] = {
+            host: re.compile('|'.join(alternatives)) for host, alternatives in host_alternatives.items()
+        }
+        self.wildcard = re.compile('|'.join(wildcard_alternatives)) if wildcard_alternatives else None
 
-class CommentListFilter(ImageFeedFilter):
-    def __init__(self, callback: Any):
-        super().__init__(callback)
-        self.url_pattern = re.compile(r'https?://edith.xiaohongshu.com/api/sns/v\d+/note/comment/list')
-        self.type = 'comment_list'
+    def classify(self, url: str) -> tuple[str, str]:
+        """Return the verdict and the pattern that produced it"""
+        scheme, _, rest = url.partition('://')
+        host, slash, path = rest.partition('/')
+        host_pattern = self.host_table.get(f"{scheme.lower()}://{host.split(':', 1)[0].lower()}")
+        match = host_pattern.match(slash + path) if host_pattern else None
+        if match is None and self.wildcard:
+            match = self.wildcard.match(url)
+        if match is None or match.lastgroup is None:
+            return self.PASS, ''
+        return self.rules[int(match.lastgroup[1:])]
+
+class XHSFlowRouter:
+    """Send note and comment list captures to the relay and answer blocked URLs locally"""
+    def __init__(self, classifier: URLClassifier, callback: Any, block_phase: str = 'request'):
+        self.classifier = classifier
+        self.callback = callback
+        # 'request' answers blocked flows before they go upstream, 'response' blanks them after the upstream answered
+        self.block_phase = block_phase
+        self.block_hits: Counter[str] = Counter()
+
+    def request(self, flow: http.HTTPFlow) -> None:
+        verdict, pattern = self.classifier.classify(flow.request.pretty_url)
+        flow.metadata['xhs_verdict'] = verdict
+        if verdict == URLClassifier.BLOCK and self.block_phase == 'request':
+            flow.response = http.Response.make(345, b"{'fuckxhs': true}")
+            self.count_block(pattern)
 
     def response(self, flow: http.HTTPFlow) -> None:
-        if re.findall(self.url_pattern, flow.request.pretty_url):
+        if 'xhs_verdict' in flow.metadata:
+            verdict, pattern = flow.metadata['xhs_verdict'], ''
+        else:
+            verdict, pattern = self.classifier.classify(flow.request.pretty_url)
+        if verdict in (URLClassifier.NOTE, URLClassifier.COMMENT_LIST):
             data = flow.response
             if data is not None:
                 json_data = data.json()
             else:
                 json_data = {}
             self.callback(
-                note_id=self.get_note_id(flow.request.pretty_url),
+                note_id=get_note_id(flow.request.pretty_url),
                 url=flow.request.pretty_url,
                 data=json_data,
-                type=self.type
+                type=verdict,
+                client_ip=flow.client_conn.peername[0] if flow.client_conn.peername else ''
             )
-
-
-class BlockURLs:
-    def __init__(self, block_pattern_list: list[str]):
-        self.block_pattern_list = block_pattern_list
-    
-    def response(self, flow: http.HTTPFlow) -> None:
-        if [True for pattern in self.block_pattern_list if re.findall(pattern, flow.request.pretty_url)]:
-            if not flow.response:
-                return
-            flow.response.status_code = 345
-            flow.response.content = b"{'fuckxhs': true}"
+        elif verdict == URLClassifier.BLOCK:
             view = ctx.master.addons.get("view") # type: ignore
             if view.store_count() >= 10: # type: ignore
                 view.clear() # type: ignore
+            if self.block_phase == 'request' or not flow.response:
+                return
+            flow.response.status_code = 345
+            flow.response.content = b"{'fuckxhs': true}"
+            self.count_block(pattern or self.classifier.classify(flow.request.pretty_url)[1])
+
+    def count_block(self, pattern: str) -> None:
+        self.block_hits[pattern] += 1
+        total = self.block_hits.total()
+        if total % 100 == 0:
+            logging.info(f"Blocked {total} flows, top patterns: {self.block_hits.most_common(5)}")
+
+    def done(self) -> None:
+        logging.info(f"Blocked flows per pattern: {dict(self.block_hits)}")
+
+def get_capture_pattern_list() -> dict[str, str]:
+    return {
+        URLClassifier.NOTE: r'https://edith.xiaohongshu.com/api/sns/v\d+/note/imagefeed',
+        URLClassifier.COMMENT_LIST: r'https?://edith.xiaohongshu.com/api/sns/v\d+/note/comment/list',
+    }
 
 def get_block_pattern_list() -> list[str]:
     return [
@@ -131,10 +229,15 @@ def get_block_pattern_list() -> list[str]:
         # r'https?://edith.xiaohongshu.com/api/sns/v\d/note/user/posted\S*',
     ]
 
+capture_sender = CaptureSender(max_queue=int(os.getenv('CAPTURE_QUEUE_SIZE', '64')))
+
 addons: list[Any] = [
-    ImageFeedFilter(set_request),
-    CommentListFilter(set_request),
-    BlockURLs(get_block_pattern_list()),
+    capture_sender,
+    XHSFlowRouter(
+        URLClassifier(get_capture_pattern_list(), get_block_pattern_list()),
+        capture_sender,
+        block_phase=os.getenv('BLOCK_PHASE', 'request')
+    ),
 ]
 
 def run_mitm():
@@ -1,16 +1,19 @@
 import sys
 import os
+import json
+import time
 import logging
+import threading
 import paramiko
 import subprocess
 from dotenv import load_dotenv
 from typing import Any
+from collections import OrderedDict
 from flask import Flask, request, jsonify
 
 load_dotenv()
 app = Flask(__name__)
-note_requests: dict[str, Any] = {}
-comment_list_requests: dict[str, Any] = {}
+max_wait_seconds = float(os.getenv('MAX_WAIT_SECONDS', '30'))
 
 logger = logging.getLogger()
 formatter = logging.Formatter(fmt="%(asctime)s.%(msecs)03d %(levelname)s %(module)s: %(message)s",datefmt=r"%H:%M:%S")
@@ -19,48 +22,199 @@ handler.setLevel(logging.DEBUG)
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
-if os.getenv('TARGET_DEVICE_TYPE') == '1':
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh_ip = os.getenv('SSH_IP')
-    if not ssh_ip:
-        raise ValueError("SSH_IP environment variable is required")
-    ssh_port = os.getenv('SSH_PORT')
-    if not ssh_port:
-        raise ValueError("SSH_PORT environment variable is required")
-    ssh.connect(
-        ssh_ip,
-        port=int(ssh_port),
-        username=os.getenv('SSH_USERNAME'),
-        password=os.getenv('SSH_PASSWORD')
-    )
-else:
-    ssh = None
-
-def home_page(connected_ssh_client: paramiko.SSHClient | None = None):
-    if os.getenv('TARGET_DEVICE_TYPE') == '0':
-        subprocess.run(["adb", "shell", "am", "start", "-d", "xhsdiscover://home"])
-    elif os.getenv('TARGET_DEVICE_TYPE') == '1':
-        if connected_ssh_client:
-            _, _, _ = connected_ssh_client.exec_command(
-                "uiopen xhsdiscover://home"
+class CaptureStore:
+    """Captures by note id, safe to share between request threads, bounded in size and expiring after a TTL"""
+    def __init__(self, max_entries: int, ttl: float) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, dict[str, Any]] = OrderedDict()  # Oldest first
+        self.condition = threading.Condition()  # Signalled on every put, wakes up long-polling fetchers
+        self.version = 0  # Bumped on every put, a fetch can ignore captures stored before its note was opened
+        self.counters: dict[str, int] = {"stored": 0, "hits": 0, "misses": 0, "stale": 0, "evicted": 0, "expired": 0}
+
+    def expire(self) -> None:
+        """Drop captures older than the TTL, the condition must be held"""
+        now = time.monotonic()
+        while self.entries:
+            note_id, capture = next(iter(self.entries.items()))
+            if now - capture["stored_at"] <= self.ttl:
+                break
+            del self.entries[note_id]
+            self.counters["expired"] += 1
+
+    def put(self, note_id: str, capture: dict[str, Any]) -> None:
+        with self.condition:
+            self.expire()
+            self.version += 1
+            capture["version"] = self.version
+            capture["stored_at"] = time.monotonic()
+            self.entries[note_id] = capture
+            self.entries.move_to_end(note_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters["evicted"] += 1
+            self.counters["stored"] += 1
+            self.condition.notify_all()
+
+    def current_version(self) -> int:
+        with self.condition:
+            return self.version
+
+    def pop(self, note_id: str, timeout: float = 0, min_version: int = 0) -> dict[str, Any]:
+        """Remove and return a capture newer than min_version, waiting up to timeout seconds for it to arrive; {} if it does not"""
+        def fresh() -> bool:
+            capture = self.entries.get(note_id)
+            return capture is not None and capture["version"] > min_version
+        with self.condition:
+            self.expire()
+            self.condition.wait_for(fresh, timeout=timeout)
+            if not fresh():
+                # A capture left over from an earlier open of the note is not served, it expires with the TTL
+                self.counters["stale" if note_id in self.entries else "misses"] += 1
+                return {}
+            capture = self.entries.pop(note_id)
+            self.counters["hits"] += 1
+            capture.pop("stored_at", None)
+            return capture
+
+    def stats(self) -> dict[str, int]:
+        with self.condition:
+            self.expire()
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "version": self.version, **self.counters}
+
+capture_store_size = int(os.getenv('CAPTURE_STORE_SIZE', '200'))
+capture_ttl_seconds = float(os.getenv('CAPTURE_TTL_SECONDS', '120'))
+note_requests = CaptureStore(capture_store_size, capture_ttl_seconds)
+comment_list_requests = CaptureStore(capture_store_size, capture_ttl_seconds)
+
+def get_timeout() -> float:
+    """Seconds a fetch may long-poll for its capture, from the `timeout` query parameter"""
+    return min(max(request.args.get('timeout', 0, type=float), 0), max_wait_seconds)
+
+def get_min_version() -> int:
+    """Version returned by /open_note, only captures stored after it are served"""
+    return request.args.get('min_version', 0, type=int)
+
+class Device:
+    """A phone or emulator with REDNote installed that notes are opened on"""
+    def __init__(self, config: dict[str, Any]) -> None:
+        self.type = str(config.get('type', ''))  # 0: Android with root; 1: Jailbroken iOS; anything else opens nothing
+        self.serial: str = config.get('serial', '')  # adb serial, only needed with several Android devices
+        self.ip: str = config.get('ip', '')  # Address the device's proxied traffic comes from
+        self.name: str = config.get('name', '') or self.serial or self.ip or 'device'
+        self.ssh: paramiko.SSHClient | None = None
+        if self.type == '1' and (config.get('ssh_ip') or self.ip):
+            self.ssh = paramiko.SSHClient()
+            self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            self.ssh.connect(
+                config.get('ssh_ip') or self.ip,
+                port=int(config.get('ssh_port', 22)),
+                username=config.get('ssh_username'),
+                password=config.get('ssh_password')
             )
+        self.note_id = ''  # Note being opened, empty when idle
+        self.pending: set[str] = set()  # Captures still expected for note_id
+        self.opened_at = 0.0
+
+    def open_url(self, url: str) -> None:
+        if self.type == '0':
+            subprocess.run(["adb"] + (["-s", self.serial] if self.serial else []) + ["shell", "am", "start", "-d", url])
+        elif self.type == '1':
+            if self.ssh:
+                _, _, _ = self.ssh.exec_command(f"uiopen {url}")
+            else:
+                subprocess.run(["uiopen", url])
         else:
-            subprocess.run(["uiopen", "xhsdiscover://home"])
+            logger.warning(f"{self.name} has no device type, not opening {url}")
+
+    def is_idle(self, now: float) -> bool:
+        # A device whose captures never arrived is given back after device_busy_seconds
+        return not self.note_id or now - self.opened_at > device_busy_seconds
+
+def load_devices() -> list[Device]:
+    """Devices from the DEVICES JSON list, or the single device described by TARGET_DEVICE_TYPE and SSH_*"""
+    devices_config = os.getenv('DEVICES')
+    if devices_config:
+        configs: list[dict[str, Any]] = json.loads(devices_config)
+        if any('type' not in config for config in configs):
+            raise ValueError("Every DEVICES entry needs a type")
+        return [Device(config) for config in configs]
+    if os.getenv('TARGET_DEVICE_TYPE') == '1':
+        ssh_ip = os.getenv('SSH_IP')
+        if not ssh_ip:
+            raise ValueError("SSH_IP environment variable is required")
+        ssh_port = os.getenv('SSH_PORT')
+        if not ssh_port:
+            raise ValueError("SSH_PORT environment variable is required")
+        return [Device({
+            'type': '1',
+            'ssh_ip': ssh_ip,
+            'ssh_port': ssh_port,
+            'ssh_username': os.getenv('SSH_USERNAME'),
+            'ssh_password': os.getenv('SSH_PASSWORD'),
+        })]
+    # Without TARGET_DEVICE_TYPE notes are not opened, as before devices could be described
+    return [Device({'type': os.getenv('TARGET_DEVICE_TYPE', '')})]
+
+device_interval_seconds = float(os.getenv('DEVICE_INTERVAL_SECONDS', '2'))  # Min pause between two notes on one device
+device_busy_seconds = float(os.getenv('DEVICE_BUSY_SECONDS', '10'))  # Max time a device waits for its captures
+device_wait_seconds = float(os.getenv('DEVICE_WAIT_SECONDS', '30'))  # Max time an open_note waits for an idle device
+devices = load_devices()
+device_condition = threading.Condition()
+logger.info(f"Devices: {', '.join(device.name for device in devices)}")
+
+def acquire_device(note_id: str) -> Device | None:
+    """Reserve the idle device that has rested the longest, waiting for one up to device_wait_seconds"""
+    deadline = time.monotonic() + device_wait_seconds
+    with device_condition:
+        while True:
+            now = time.monotonic()
+            idle = [device for device in devices if device.is_idle(now)]
+            if idle:
+                device = min(idle, key=lambda d: d.opened_at)
+                rest = device.opened_at + device_interval_seconds - now
+                if rest <= 0:
+                    device.note_id = note_id
+                    device.pending = {'note', 'comment_list'}
+                    device.opened_at = now
+                    return device
+            else:
+                rest = min(d.opened_at + device_busy_seconds for d in devices) - now
+            if now >= deadline:
+                return None
+            device_condition.wait(timeout=max(0.01, min(rest, deadline - now)))
+
+def release_device(note_id: str, kind: str, client_ip: str = '') -> Device | None:
+    """Mark a capture as arrived, the device is idle again once all its captures are in"""
+    client_ip = client_ip.removeprefix('::ffff:')
+    with device_condition:
+        for device in devices:
+            # Match by the address the capture came from, or by the note when addresses are not configured
+            if device.ip and client_ip:
+                matched = device.ip == client_ip
+            else:
+                matched = device.note_id == note_id
+            if not matched:
+                continue
+            if device.note_id == note_id:
+                device.pending.discard(kind)
+                if not device.pending:
+                    device.note_id = ''
+                    device_condition.notify_all()
+            return device
+    return None
 
 @app.route("/open_note/<noteId>", methods=["GET"])
 def open_note(noteId: str):
     anchorCommentId = request.args.get('anchorCommentId', '')
-    if os.getenv('TARGET_DEVICE_TYPE') == '0':
-        subprocess.run(["adb", "shell", "am", "start", "-d", f"xhsdiscover://item/{noteId}" + (f"?anchorCommentId={anchorCommentId}" if anchorCommentId else '')])
-    elif os.getenv('TARGET_DEVICE_TYPE') == '1':
-        if ssh:
-            _, _, _ = ssh.exec_command(
-                f"uiopen xhsdiscover://item/{noteId}" + (f"?anchorCommentId={anchorCommentId}" if anchorCommentId else '')
-            )
-        else:
-            subprocess.run(["uiopen", f"xhsdiscover://item/{noteId}" + (f"?anchorCommentId={anchorCommentId}" if anchorCommentId else '')])
-    return jsonify({"status": "success"})
+    device = acquire_device(noteId)
+    if device is None:
+        logger.warning(f"No idle device to open note {noteId}")
+        return jsonify({"status": "error", "message": "No idle device"}), 503
+    versions = {"note": note_requests.current_version(), "comment_list": comment_list_requests.current_version()}
+    device.open_url(f"xhsdiscover://item/{noteId}" + (f"?anchorCommentId={anchorCommentId}" if anchorCommentId else ''))
+    logger.info(f"Note opened: {noteId} on {device.name}")
+    return jsonify({"status": "success", "device": device.name, "versions": versions})
 
 @app.route("/set_note", methods=["POST"])
 def set_note():
@@ -68,11 +222,13 @@ def set_note():
     if data is None:
         return jsonify({"status": "error", "message": "No data provided"}), 400
     note_id = data["note_id"]
-    note_requests[note_id] = {
+    device = release_device(note_id, "note", data.get("client_ip", ""))
+    note_requests.put(note_id, {
         "url": data["url"],
-        "data": data["data"]
-    }
-    logger.info(f"Note set: {note_id}, {data['url']}")
+        "data": data["data"],
+        "device": device.name if device else ""
+    })
+    logger.info(f"Note set: {note_id} from {device.name if device else 'unknown device'}, {data['url']}")
     return jsonify({"status": "ok"})
 
 @app.route("/set_comment_list", methods=["POST"])
@@ -81,27 +237,41 @@ def set_comment_list():
     if data is None:
         return jsonify({"status": "error", "message": "No data provided"}), 400
     note_id = data["note_id"]
-    comment_list_requests[note_id] = {
+    device = release_device(note_id, "comment_list", data.get("client_ip", ""))
+    comment_list_requests.put(note_id, {
         "url": data["url"],
-        "data": data["data"]
-    }
-    logger.info(f"Comment list set: {note_id}, {data['url']}")
+        "data": data["data"],
+        "device": device.name if device else ""
+    })
+    logger.info(f"Comment list set: {note_id} from {device.name if device else 'unknown device'}, {data['url']}")
     return jsonify({"status": "ok"})
 
 @app.route("/get_note/<note_id>")
 def get_note(note_id: str):
-    json_data = jsonify(note_requests.get(note_id, {}))
-    del note_requests[note_id]  # Remove after fetching
+    json_data = jsonify(note_requests.pop(note_id, get_timeout(), get_min_version()))
     logger.info(f"Note fetched: {note_id}")
     return json_data
 
 @app.route("/get_comment_list/<note_id>")
 def get_comment_list(note_id: str):
-    json_data = jsonify(comment_list_requests.get(note_id, {}))
-    del comment_list_requests[note_id]  # Remove after fetching
+    comment_list = comment_list_requests.pop(note_id, get_timeout(), get_min_version())
+    if not comment_list:
+        # The bot only polls for the comment list for a grace period after the note, notes without one free their device here
+        release_device(note_id, "comment_list")
     logger.info(f"Comment list fetched: {note_id}")
-    return json_data
+    return jsonify(comment_list)
+
+@app.route("/stats")
+def stats():
+    with device_condition:
+        now = time.monotonic()
+        busy = {device.name: device.note_id if not device.is_idle(now) else "" for device in devices}
+    return jsonify({
+        "note": note_requests.stats(),
+        "comment_list": comment_list_requests.stats(),
+        "devices": busy,
+    })
 
 if __name__ == "__main__":
     port = os.getenv("SHARED_SERVER_PORT")
-    app.run(port=int(port) if port else 5001)
\ No newline at end of file
+    app.run(port=int(port) if port else 5001, threaded=True)
\ No newline at end of file
@@ -0,0 +1,66 @@
+"""Escaping of note text for Telegram MarkdownV2 and HTML, checked against the original implementations"""
+import os
+import random
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xhsfeedbot import make_block_quotation, tg_msg_escape_html, tg_msg_escape_markdown_v2
+
+def old_escape_markdown_v2(t: str | int) -> str:
+    t = str(t)
+    for i in ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']:
+        t = t.replace(i, "\\" + i)
+    return t
+
+def old_make_block_quotation(text: str) -> str:
+    lines = [f'>{old_escape_markdown_v2(line)}' for line in text.split('\n') if len(line) > 0 and bool(re.findall(r'\S+', line))]
+    if len(lines) > 3:
+        lines[0] = f'**{lines[0]}'
+        lines[-1] = f'{lines[-1]}||'
+    return '\n'.join(lines)
+
+NOTE_TEXTS = [
+    '',
+    '今天去了外滩，人好多！！！',
+    '#上海旅游[话题]# #周末去哪儿[话题]#',
+    '价格：¥128/人 (含税) 评分 4.5/5.0',
+    '1. 早上8:00出发\n2. 中午12:00吃饭\n\n3. 晚上~回家',
+    '链接 https://www.xiaohongshu.com/explore/68a1b2c3d4e5f60718293a4b?xsec_token=AB_cd-EF=',
+    '`code` *bold* _italic_ [link](url) {a|b} a+b=c >quote',
+    '   \n\t\n　\n',
+    '😂😂😂 [笑哭R] 哈哈哈',
+    'A & B <tag> "quoted" \'single\'',
+    12345,
+]
+
+def fuzz_texts(count: int = 5000) -> list[str]:
+    rng = random.Random(3)
+    alphabet = list('_*[]()~`>#+-=|{}.!&<>"\' \n\t　') + ['好', 'a', '😂', '1']
+    return [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 80))) for _ in range(count)]
+
+def test_markdown_v2_matches_original_without_backslash():
+    for text in NOTE_TEXTS + fuzz_texts():
+        assert tg_msg_escape_markdown_v2(text) == old_escape_markdown_v2(text)
+
+def test_markdown_v2_escapes_backslash():
+    # The original left backslashes alone, so a literal backslash escaped the character after it
+    assert tg_msg_escape_markdown_v2('C:\\Users') == 'C:\\\\Users'
+    assert tg_msg_escape_markdown_v2('a\\_b') == 'a\\\\\\_b'
+    assert tg_msg_escape_markdown_v2('\\') == '\\\\'
+
+def test_block_quotation_matches_original():
+    for text in NOTE_TEXTS[:-1] + fuzz_texts():
+        assert make_block_quotation(text) == old_make_block_quotation(text)
+
+def test_block_quotation_collapses_long_quotes():
+    assert make_block_quotation('a\nb\n\nc\nd') == '**>a\n>b\n>c\n>d||'
+    assert make_block_quotation('a\n \nb') == '>a\n>b'
+
+def test_html_escape():
+    assert tg_msg_escape_html('A & B <tag>') == 'A &amp; B &lt;tag&gt;'
+    # The original escaped '&' last and turned '<' into '&amp;lt;'
+    assert tg_msg_escape_html('<') == '&lt;'
+    assert tg_msg_escape_html('&amp;') == '&amp;amp;'
+    assert tg_msg_escape_html('"quoted"') == '"quoted"'
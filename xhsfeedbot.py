@@ -11,12 +11,21 @@ import traceback
 import subprocess
 # import paramiko
 import threading
+import queue
+import sqlite3
 import base64
+import hashlib
+import tempfile
+import httpx
+import zstandard
+from collections import defaultdict, OrderedDict
 from datetime import datetime, timedelta, timezone
 from pprint import pformat
 from dotenv import load_dotenv
 from urllib.parse import unquote, urljoin, parse_qs, urlparse, quote
-from typing import Any
+from typing import Any, AsyncIterator, Sequence
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from io import BytesIO
 from Crypto.Cipher import AES
@@ -40,6 +49,7 @@ from telegram import (
     MessageEntity,
     InputMediaPhoto,
     InputMediaVideo,
+    InputFile,
     LinkPreviewOptions,
     InlineQueryResultArticle,
     Message,
@@ -48,7 +58,9 @@ from telegram import (
 )
 from telegram.error import (
     NetworkError,
-    BadRequest
+    BadRequest,
+    RetryAfter,
+    TelegramError
 )
 from telegram.constants import (
     ParseMode,
@@ -92,6 +104,13 @@ is_network_healthy = True
 max_concurrent_requests = 5  # Maximum number of concurrent note processing
 processing_semaphore = asyncio.Semaphore(max_concurrent_requests)
 
+# Notes being fetched, keyed by noteId, xsec_token mode and anchorCommentId
+inflight_notes: dict[str, asyncio.Task[Any]] = {}
+
+# Capture waiting, the relay answers as soon as the device has captured the note
+capture_timeout = float(os.getenv('CAPTURE_TIMEOUT', '15'))  # Max seconds to wait for the note capture
+comment_list_grace = float(os.getenv('COMMENT_LIST_GRACE', '3'))  # Extra seconds to wait for comments once the note arrived
+
 # Whitelist functionality
 whitelist_enabled = os.getenv('WHITELIST_ENABLED', 'false').lower() == 'true'
 bot_logger.debug(f"Whitelist enabled: {whitelist_enabled}")
@@ -122,23 +141,741 @@ with open('redtoemoji.json', 'r', encoding='utf-8') as f:
     redtoemoji = json.load(f)
     f.close()
 
-URL_REGEX = r"""(?i)\b((?:https?:(?:/{1,3}|[a-z0-9%])|[a-z0-9.\-]+[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)/)(?:[^\s()<>{}\[\]]+|\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\))+(?:\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\)|[^\s`!()\[\]{};:\'\".,<>?«»“”‘’])|(?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\b/?(?!@)))"""
-
 FLASK_SERVER_NAME = os.getenv('FLASK_SERVER_NAME', '127.0.0.1')
 
-def replace_redemoji_with_emoji(text: str) -> str:
-    for red_emoji, emoji in redtoemoji.items():
-        text = text.replace(red_emoji, emoji)
-    return text
+# Counters and timings, reported to the admin with /stats
+# Recorded from the event loop and from the cache, archive and registry threads
+metrics: defaultdict[str, float] = defaultdict(float)
+metrics_lock = threading.Lock()
+
+def record_metric(name: str, value: float = 1) -> None:
+    with metrics_lock:
+        metrics[name] += value
+
+def snapshot_metrics() -> dict[str, float]:
+    with metrics_lock:
+        return dict(metrics)
+
+# Outbound HTTP: one pooled keep-alive client per host class
+http_timeouts: dict[str, httpx.Timeout] = {
+    'relay': httpx.Timeout(10),
+    'media': httpx.Timeout(15, read=60),
+    'xhs': httpx.Timeout(10),
+    'default': httpx.Timeout(15),
+}
+http_clients: dict[str, httpx.AsyncClient] = {}
+
+def get_host_class(url: str) -> str:
+    host = urlparse(url).hostname or ''
+    if host == FLASK_SERVER_NAME:
+        return 'relay'
+    if host.endswith(('.xhscdn.com', '.xhscdn.net')):
+        return 'media'
+    if host.endswith(('xhslink.com', 'xiaohongshu.com')):
+        return 'xhs'
+    return 'default'
+
+def get_http_client(host_class: str) -> httpx.AsyncClient:
+    """Get the shared client of a host class, created lazily inside the running event loop"""
+    client = http_clients.get(host_class)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=host_class == 'media',  # xhscdn hosts multiplex all media downloads over HTTP/2
+            timeout=http_timeouts[host_class],
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60),
+            follow_redirects=True,
+        )
+        http_clients[host_class] = client
+    return client
 
-def check_network_connectivity() -> bool:
-    """Check if network connectivity is available by testing multiple endpoints"""
-    test_urls = [
-        "https://api.telegram.org",
-        "https://www.google.com", 
-        "https://1.1.1.1"
-    ]
+async def http_request(method: str, url: str, **kwargs: Any) -> httpx.Response:
+    host_class = get_host_class(url)
+    start_time = time.monotonic()
+    try:
+        response = await get_http_client(host_class).request(method, url, **kwargs)
+    except httpx.HTTPError:
+        record_metric(f'http.{host_class}.errors')
+        raise
+    finally:
+        record_metric(f'http.{host_class}.requests')
+        record_metric(f'http.{host_class}.seconds', time.monotonic() - start_time)
+    record_metric(f'http.{host_class}.bytes', len(response.content))
+    return response
+
+async def http_get(url: str, **kwargs: Any) -> httpx.Response:
+    return await http_request('GET', url, **kwargs)
+
+@asynccontextmanager
+async def http_stream(method: str, url: str, **kwargs: Any) -> AsyncIterator[httpx.Response]:
+    """Like http_request, but the body is left unread for the caller to iterate"""
+    host_class = get_host_class(url)
+    start_time = time.monotonic()
+    try:
+        async with get_http_client(host_class).stream(method, url, **kwargs) as response:
+            try:
+                yield response
+            finally:
+                record_metric(f'http.{host_class}.bytes', response.num_bytes_downloaded)
+    except httpx.HTTPError:
+        record_metric(f'http.{host_class}.errors')
+        raise
+    finally:
+        record_metric(f'http.{host_class}.requests')
+        record_metric(f'http.{host_class}.seconds', time.monotonic() - start_time)
+
+# Media downloads: kept in memory up to spool_max_memory, then spooled to disk
+spool_max_memory = int(os.getenv('SPOOL_MAX_MEMORY', str(8 * 1024 * 1024)))
+range_chunk_size = int(os.getenv('RANGE_CHUNK_SIZE', str(4 * 1024 * 1024)))
+range_parallelism = int(os.getenv('RANGE_PARALLELISM', '4'))
+
+# Media prefetch: assets of a note start downloading as soon as it is parsed, a few at a time per host
+prefetch_per_host = int(os.getenv('PREFETCH_PER_HOST', '6'))
+prefetch_semaphores: dict[str, asyncio.Semaphore] = {}
+
+async def fetch_media(url: str) -> bytes:
+    host = urlparse(url).hostname or ''
+    semaphore = prefetch_semaphores.setdefault(host, asyncio.Semaphore(prefetch_per_host))
+    async with semaphore:
+        response = await http_get(url)
+    response.raise_for_status()
+    return response.content
+
+async def download_ranges(url: str, size: int, spool: tempfile.SpooledTemporaryFile[bytes]) -> None:
+    """Fetch url as concurrent byte ranges, each written at its own offset of the spool"""
+    semaphore = asyncio.Semaphore(range_parallelism)
+    async def fetch_range(start: int) -> None:
+        end = min(start + range_chunk_size, size) - 1
+        async with semaphore:
+            response = await http_get(url, headers={'Range': f'bytes={start}-{end}'})
+        if response.status_code != 206 or len(response.content) != end - start + 1:
+            raise httpx.HTTPError(f"Range {start}-{end} not honoured (HTTP {response.status_code}, {len(response.content)} bytes)")
+        spool.seek(start)
+        spool.write(response.content)
+    async with asyncio.TaskGroup() as tg:
+        for start in range(0, size, range_chunk_size):
+            tg.create_task(fetch_range(start))
+
+async def download_to_spool(url: str, size: int = 0, accept_ranges: bool = False) -> tempfile.SpooledTemporaryFile[bytes]:
+    """Download url into a spooled temp file, rewound and ready to be read"""
+    spool: tempfile.SpooledTemporaryFile[bytes] = tempfile.SpooledTemporaryFile(max_size=spool_max_memory)
+    if size > spool_max_memory:
+        spool.rollover()
+    try:
+        if accept_ranges and size > range_chunk_size:
+            try:
+                await download_ranges(url, size, spool)
+                spool.seek(0)
+                return spool
+            except* httpx.HTTPError as e:
+                bot_logger.warning(f"Ranged download of {url} failed, downloading in one piece: {e.exceptions}")
+                spool.seek(0)
+                spool.truncate()
+        async with http_stream('GET', url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+async def close_http_clients(_: Any = None) -> None:
+    for client in http_clients.values():
+        await client.aclose()
+    http_clients.clear()
+
+# Disk side of every PersistentCache, a single worker keeps writes, deletes and reads of a key in order
+cache_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-io')
+
+class PersistentCache:
+    """In-memory LRU in front of a JSON file store in data/cache/<name>, survives restarts
+
+    File reads, writes and pruning run on cache_io, the event loop only touches the memory LRU.
+    """
+    def __init__(self, name: str, ttl: float, max_entries: int = 1000, memory_entries: int = 128, prune_interval: float = 3600) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.memory: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.directory = os.path.join('data', 'cache', name)
+        os.makedirs(self.directory, exist_ok=True)
+        self.prune_interval = prune_interval
+        self.prune_every = max(1, max_entries // 10)
+        self.sets_since_prune = 0
+        self.next_prune = time.monotonic() + prune_interval
+        self.prune()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{hashlib.sha1(key.encode("utf-8")).hexdigest()}.json')
+
+    def remember(self, key: str, entry: tuple[float, Any]) -> None:
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def load(self, key: str) -> tuple[float, Any] | None:
+        try:
+            with open(self.path(key), 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            return (stored['time'], stored['value'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    async def get(self, key: str) -> Any | None:
+        entry = self.memory.get(key)
+        if entry is None:
+            entry = await asyncio.wrap_future(cache_io.submit(self.load, key))
+        if entry is None or time.time() - entry[0] > self.ttl:
+            record_metric(f'cache.{self.name}.miss')
+            return None
+        record_metric(f'cache.{self.name}.hit')
+        self.remember(key, entry)
+        return entry[1]
+
+    def set(self, key: str, value: Any) -> None:
+        """Store a value, the file is written in the background"""
+        entry = (time.time(), value)
+        self.remember(key, entry)
+        cache_io.submit(self.store, key, entry)
+        # Entries past max_entries or ttl only go away when pruned, do it as the cache grows and periodically
+        self.sets_since_prune += 1
+        if self.sets_since_prune >= self.prune_every or time.monotonic() >= self.next_prune:
+            self.sets_since_prune = 0
+            self.next_prune = time.monotonic() + self.prune_interval
+            cache_io.submit(self.prune)
+
+    def store(self, key: str, entry: tuple[float, Any]) -> None:
+        path = self.path(key)
+        try:
+            with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'key': key, 'time': entry[0], 'value': entry[1]}, f, ensure_ascii=False)
+            os.replace(f'{path}.tmp', path)
+        except (OSError, TypeError, ValueError) as e:
+            bot_logger.error(f"Failed to persist {self.name} cache entry {key}: {e}")
+
+    def delete(self, key: str) -> None:
+        self.memory.pop(key, None)
+        cache_io.submit(self.remove, key)
+
+    def remove(self, key: str) -> None:
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def prune(self) -> None:
+        """Remove expired files and keep only the newest max_entries on disk"""
+        files: list[tuple[float, str]] = []
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            try:
+                files.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        files.sort(reverse=True)
+        now = time.time()
+        for i, (mtime, path) in enumerate(files):
+            if i >= self.max_entries or now - mtime > self.ttl or path.endswith('.tmp'):
+                try:
+                    os.remove(path)
+                    record_metric(f'cache.{self.name}.pruned')
+                except OSError:
+                    pass
+
+# Published Telegraph pages per note, unchanged notes reuse their page and changed ones are edited in place
+# Only the page path is stored, edits go through the bot's account (TELEGRAPH_ACCESS_TOKEN keeps it across restarts)
+telegraph_pages: PersistentCache
+
+# Telegram file_id of uploaded media by source URL, later sends reference it instead of uploading again
+telegram_files: PersistentCache
+
+# Parsed note and comment list payloads, a hit skips the device round-trip
+note_cache: PersistentCache
+
+# Raw captures, kept compressed for replay instead of overwriting data/note_data-*.json
+class CaptureArchive:
+    """Append-only history of note and comment list captures in data/archive, written from a background thread
+
+    Each record is its own zstd frame appended to the current segment file, index.jsonl locates it by noteId and time.
+    Segments rotate daily or at segment_bytes, the oldest are dropped past retention or max_bytes in total.
+    """
+    def __init__(self, directory: str, segment_bytes: int, max_bytes: int, retention: float, level: int = 6, max_queue: int = 256) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.level = level
+        self.queue: queue.Queue[tuple[str, str, float, dict[str, Any]] | None] = queue.Queue(maxsize=max_queue)
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self.segments()
+        self.segment = segments[-1] if segments else self.new_segment()
+        self.prune()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def segments(self) -> list[str]:
+        """Segment file names, oldest first"""
+        return sorted(name for name in os.listdir(self.directory) if name.startswith('captures-') and name.endswith('.zst'))
+
+    def new_segment(self) -> str:
+        return f"captures-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.zst"
+
+    def prune(self) -> None:
+        """Remove the oldest segments past retention or max_bytes, along with their index lines"""
+        cutoff = time.time() - self.retention
+        sizes: list[tuple[str, int, float]] = []
+        for name in self.segments():
+            stat = os.stat(os.path.join(self.directory, name))
+            sizes.append((name, stat.st_size, stat.st_mtime))
+        total = sum(size for _, size, _ in sizes)
+        removed: set[str] = set()
+        for name, size, mtime in sizes:
+            if name == self.segment or (mtime >= cutoff and total <= self.max_bytes):
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+            removed.add(name)
+        if not removed:
+            return
+        index_path = os.path.join(self.directory, 'index.jsonl')
+        try:
+            with open(index_path, 'r', encoding='utf-8') as src, open(f'{index_path}.tmp', 'w', encoding='utf-8') as dst:
+                for line in src:
+                    if json.loads(line)['segment'] not in removed:
+                        dst.write(line)
+            os.replace(f'{index_path}.tmp', index_path)
+        except FileNotFoundError:
+            pass
+        record_metric('archive.pruned_segments', len(removed))
+        bot_logger.info(f"Pruned {len(removed)} capture archive segments")
+
+    def add(self, kind: str, noteId: str, data: dict[str, Any]) -> None:
+        """Queue a capture, the payload must not be modified afterwards"""
+        try:
+            self.queue.put_nowait((kind, noteId, time.time(), data))
+        except queue.Full:
+            record_metric('archive.dropped')
+            bot_logger.warning(f"Capture archive queue full, dropped {kind} of {noteId}")
+
+    def run(self) -> None:
+        compressor = zstandard.ZstdCompressor(level=self.level)
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                kind, noteId, captured_at, data = item
+                frame = compressor.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+                path = os.path.join(self.directory, self.segment)
+                rotated = False
+                if os.path.exists(path) and (
+                    os.path.getsize(path) + len(frame) > self.segment_bytes
+                    or not self.segment.startswith(f"captures-{datetime.now().strftime('%Y%m%d')}")
+                ):
+                    self.segment = self.new_segment()
+                    path = os.path.join(self.directory, self.segment)
+                    rotated = True
+                with open(path, 'ab') as f:
+                    offset = f.tell()
+                    f.write(frame)
+                with open(os.path.join(self.directory, 'index.jsonl'), 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({'noteId': noteId, 'kind': kind, 'time': captured_at, 'segment': self.segment, 'offset': offset, 'length': len(frame)}) + '\n')
+                record_metric('archive.records')
+                record_metric('archive.bytes', len(frame))
+                if rotated:
+                    self.prune()
+            except Exception as e:
+                record_metric('archive.errors')
+                bot_logger.error(f"Failed to archive capture: {e}")
+            finally:
+                self.queue.task_done()
+
+    def history(self, noteId: str) -> list[dict[str, Any]]:
+        """Index entries of a note, oldest first
+
+        Scans the whole index, meant for offline replay and debugging, not for the bot's request path.
+        """
+        entries: list[dict[str, Any]] = []
+        try:
+            with open(os.path.join(self.directory, 'index.jsonl'), 'r', encoding='utf-8') as f:
+                for line in f:
+                    if noteId in line:
+                        entry = json.loads(line)
+                        if entry['noteId'] == noteId:
+                            entries.append(entry)
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def load(self, entry: dict[str, Any]) -> dict[str, Any]:
+        """Read back the capture an index entry points to, for replay"""
+        with open(os.path.join(self.directory, entry['segment']), 'rb') as f:
+            f.seek(entry['offset'])
+            frame = f.read(entry['length'])
+        return json.loads(zstandard.ZstdDecompressor().decompress(frame))
+
+    def close(self, timeout: float = 5) -> None:
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+capture_archive: CaptureArchive
+
+# Sent notes by (chat_id, message_id), replaces the data/<chat>.<message>.json files read back for AI summaries
+class MessageRegistry:
+    """SQLite (WAL) registry of sent messages, writes are batched by a background thread"""
+    file_pattern = re.compile(r'^-?\d+\.\d+\.json$')
+
+    def __init__(self, path: str, retention: float, prune_interval: float = 3600, max_queue: int = 4096, max_attempts: int = 5) -> None:
+        self.path = path
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.max_attempts = max_attempts
+        self.queue: queue.Queue[tuple[Any, ...] | None] = queue.Queue(maxsize=max_queue)
+        # Puts not committed yet, so a lookup right after sending still finds them
+        self.pending: dict[tuple[int, int], dict[str, Any]] = {}
+        self.pending_lock = threading.Lock()
+        self.readers = threading.local()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = self.connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            'chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, created REAL NOT NULL, content TEXT NOT NULL, media TEXT NOT NULL, '
+            'PRIMARY KEY (chat_id, message_id)) WITHOUT ROWID'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS messages_created ON messages (created)')
+        connection.commit()
+        self.thread = threading.Thread(target=self.run, args=(connection,), daemon=True)
+        self.thread.start()
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def put(self, chat_id: int, message_id: int, data: dict[str, Any]) -> None:
+        """Register a sent message, does not touch the disk"""
+        with self.pending_lock:
+            self.pending[(chat_id, message_id)] = data
+        try:
+            self.queue.put_nowait(('put', chat_id, message_id, time.time(), data))
+        except queue.Full:
+            with self.pending_lock:
+                self.pending.pop((chat_id, message_id), None)
+            record_metric('registry.dropped')
+            bot_logger.warning(f"Message registry queue full, dropped {chat_id}.{message_id}")
+
+    def delete(self, chat_id: int, message_id: int) -> None:
+        with self.pending_lock:
+            self.pending.pop((chat_id, message_id), None)
+        try:
+            self.queue.put_nowait(('delete', chat_id, message_id))
+        except queue.Full:
+            record_metric('registry.dropped')
+
+    def lookup(self, chat_id: int, message_id: int) -> dict[str, Any] | None:
+        with self.pending_lock:
+            data = self.pending.get((chat_id, message_id))
+        if data is not None:
+            return data
+        connection: sqlite3.Connection | None = getattr(self.readers, 'connection', None)
+        if connection is None:
+            connection = self.readers.connection = self.connect()
+        row = connection.execute(
+            'SELECT content, media FROM messages WHERE chat_id = ? AND message_id = ?',
+            (chat_id, message_id)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'content': row[0], 'media': json.loads(row[1])}
+
+    async def get(self, chat_id: int, message_id: int) -> dict[str, Any] | None:
+        """Stored content and media of a message, None if the bot did not send it or it expired"""
+        return await asyncio.to_thread(self.lookup, chat_id, message_id)
+
+    def write(self, connection: sqlite3.Connection, batch: list[tuple[Any, ...]]) -> None:
+        with connection:
+            for op, *args in batch:
+                if op == 'put':
+                    chat_id, message_id, created, data = args
+                    connection.execute(
+                        'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)',
+                        (chat_id, message_id, created, data.get('content', ''), json.dumps(data.get('media', []), ensure_ascii=False))
+                    )
+                else:
+                    connection.execute('DELETE FROM messages WHERE chat_id = ? AND message_id = ?', args)
+        self.forget(batch)
+        record_metric('registry.writes', len(batch))
+        record_metric('registry.batches')
+
+    def forget(self, batch: list[tuple[Any, ...]]) -> None:
+        """Drop the pending entries of a batch, unless a newer put replaced them"""
+        with self.pending_lock:
+            for op, chat_id, message_id, *rest in batch:
+                if op == 'put' and self.pending.get((chat_id, message_id)) is rest[1]:
+                    del self.pending[(chat_id, message_id)]
+
+    def migrate(self, connection: sqlite3.Connection, directory: str) -> None:
+        """Move the per-message JSON files written by older versions into the registry"""
+        migrated = 0
+        rows: list[tuple[Any, ...]] = []
+        paths: list[str] = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or not self.file_pattern.match(entry.name):
+                    continue
+                chat_id, message_id, _ = entry.name.split('.')
+                try:
+                    with open(entry.path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    rows.append((int(chat_id), int(message_id), entry.stat().st_mtime, data.get('content', ''), json.dumps(data.get('media', []), ensure_ascii=False)))
+                except Exception as e:
+                    # Left in place, only files that made it into the registry are removed
+                    bot_logger.warning(f"Skipping unreadable message file {entry.name}: {e}")
+                    continue
+                paths.append(entry.path)
+                if len(paths) >= 1000:
+                    migrated += self.migrate_batch(connection, rows, paths)
+        migrated += self.migrate_batch(connection, rows, paths)
+        if migrated:
+            record_metric('registry.migrated', migrated)
+            bot_logger.info(f"Migrated {migrated} message files into {self.path}")
+
+    def migrate_batch(self, connection: sqlite3.Connection, rows: list[tuple[Any, ...]], paths: list[str]) -> int:
+        with connection:
+            # Messages registered since are newer than the files
+            connection.executemany('INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)', rows)
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        count = len(rows)
+        rows.clear()
+        paths.clear()
+        return count
+
+    def prune(self, connection: sqlite3.Connection) -> None:
+        """Forget messages past retention along with their LLM image derivatives"""
+        cutoff = time.time() - self.retention
+        with connection:
+            pruned = connection.execute('DELETE FROM messages WHERE created < ?', (cutoff,)).rowcount
+        if os.path.isdir(llm_media_directory):
+            with os.scandir(llm_media_directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.stat().st_mtime < cutoff:
+                            os.remove(entry.path)
+                    except OSError:
+                        pass
+        if pruned:
+            record_metric('registry.pruned', pruned)
+            bot_logger.info(f"Pruned {pruned} messages older than {self.retention / 86400:g} days")
+
+    def run(self, connection: sqlite3.Connection) -> None:
+        try:
+            self.migrate(connection, os.path.dirname(self.path))
+        except Exception as e:
+            bot_logger.error(f"Failed to migrate message files: {e}")
+        next_prune = 0.0
+        # A failed batch is kept and retried with backoff, together with whatever queued up meanwhile
+        batch: list[tuple[Any, ...]] = []
+        failures = 0
+        retry_at = 0.0
+        while True:
+            if time.monotonic() >= next_prune:
+                try:
+                    self.prune(connection)
+                except Exception as e:
+                    bot_logger.error(f"Failed to prune message registry: {e}")
+                next_prune = time.monotonic() + self.prune_interval
+            timeout = max(retry_at - time.monotonic(), 0) if failures else self.prune_interval
+            # Whatever queued up while the last commit ran goes into one transaction
+            closing = False
+            try:
+                item = self.queue.get(timeout=timeout)
+                while item is not None:
+                    batch.append(item)
+                    item = self.queue.get_nowait()
+                closing = True
+            except queue.Empty:
+                pass
+            if not batch or (failures and not closing and time.monotonic() < retry_at):
+                if closing:
+                    connection.close()
+                    return
+                continue
+            try:
+                self.write(connection, batch)
+            except Exception as e:
+                failures += 1
+                record_metric('registry.errors')
+                if failures < self.max_attempts and not closing:
+                    retry_at = time.monotonic() + min(2 ** failures, 60)
+                    bot_logger.warning(f"Failed to write message registry, retrying {len(batch)} operations: {e}")
+                    continue
+                # Still answered from memory until here, give up so pending does not grow forever
+                self.forget(batch)
+                record_metric('registry.dropped', len(batch))
+                bot_logger.error(f"Failed to write message registry, dropped {len(batch)} operations: {e}")
+            batch = []
+            failures = 0
+            if closing:
+                connection.close()
+                return
+
+    def close(self, timeout: float = 5) -> None:
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+# Resolved xhslink.com short links by path, repeated shares skip the redirect
+short_links: PersistentCache
+
+# Voice comments converted to Ogg/Opus by audio URL (base64), so a clip is only transcoded once
+voice_cache: PersistentCache
+voice_conversions: dict[str, asyncio.Task[bytes]] = {}
+
+def voice_conversion_done(audio_url: str, task: asyncio.Task[bytes]) -> None:
+    voice_conversions.pop(audio_url, None)
+    # Retrieved here as every waiter may have been cancelled, the next request converts again
+    if not task.cancelled() and task.exception() is not None:
+        record_metric('voice.conversion_failed')
+
+# Generated AI summaries by hash of the note content and media, copies of a note share one summary
+summary_cache: PersistentCache
+
+# Note images downscaled for the LLM, built in worker threads when the note is sent
+llm_media_directory = os.path.join('data', 'llm_media')
+llm_image_workers = int(os.getenv('LLM_IMAGE_WORKERS', '2'))
+# Threads rather than processes: Pillow releases the GIL while decoding, resizing and encoding
+llm_image_pool = ThreadPoolExecutor(max_workers=llm_image_workers, thread_name_prefix='llm-image')
+background_tasks: set[asyncio.Task[Any]] = set()
+
+message_registry: MessageRegistry
+
+def llm_media_path(url: str) -> str:
+    return os.path.join(llm_media_directory, f'{hashlib.sha256(remove_image_url_params(url).encode()).hexdigest()}.jpg')
+
+def make_llm_derivative(path: str, media_bytes: bytes) -> bytes:
+    """Fit an image into 1280x720 as JPEG and save it to path, runs in llm_image_pool"""
+    img = Image.open(BytesIO(media_bytes))
+    # thumbnail() decodes JPEGs at reduced scale (draft) and shrinks by integer factors (reduce) before resampling
+    img.thumbnail((1280, 720), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    output = BytesIO()
+    img.convert('RGB').save(output, format='JPEG', quality=70, optimize=True)
+    derivative = output.getvalue()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(derivative)
+    os.replace(f'{path}.tmp', path)
+    return derivative
+
+async def build_llm_derivative(url: str, media_bytes: bytes) -> bytes:
+    start_time = time.monotonic()
+    derivative = await asyncio.get_running_loop().run_in_executor(llm_image_pool, make_llm_derivative, llm_media_path(url), media_bytes)
+    record_metric('llm_media.built')
+    record_metric('llm_media.seconds', time.monotonic() - start_time)
+    return derivative
+
+async def close_llm_image_pool(_: Any = None) -> None:
+    llm_image_pool.shutdown(wait=False, cancel_futures=True)
+
+# Stores under data/ are opened when the bot starts, not when the module is imported (tests, benchmarks)
+storage_open = False
+
+def open_storage() -> None:
+    global storage_open, telegraph_pages, telegram_files, note_cache, short_links, voice_cache, summary_cache, capture_archive, message_registry
+    telegraph_pages = PersistentCache(
+        'telegraph',
+        ttl=float(os.getenv('TELEGRAPH_CACHE_TTL', str(30 * 24 * 3600))),
+        max_entries=20000
+    )
+    telegram_files = PersistentCache(
+        'file_id',
+        ttl=float(os.getenv('FILE_ID_CACHE_TTL', str(90 * 24 * 3600))),
+        max_entries=20000,
+        memory_entries=4096
+    )
+    note_cache = PersistentCache(
+        'note',
+        ttl=float(os.getenv('NOTE_CACHE_TTL', '600')),
+        max_entries=int(os.getenv('NOTE_CACHE_SIZE', '500')),
+        memory_entries=32
+    )
+    short_links = PersistentCache(
+        'short_link',
+        ttl=float(os.getenv('SHORT_LINK_CACHE_TTL', str(7 * 24 * 3600))),
+        max_entries=20000,
+        memory_entries=1024
+    )
+    voice_cache = PersistentCache(
+        'voice',
+        ttl=float(os.getenv('VOICE_CACHE_TTL', str(30 * 24 * 3600))),
+        max_entries=2000,
+        memory_entries=16
+    )
+    summary_cache = PersistentCache(
+        'summary',
+        ttl=float(os.getenv('SUMMARY_CACHE_TTL', str(7 * 24 * 3600))),
+        max_entries=int(os.getenv('SUMMARY_CACHE_SIZE', '2000')),
+        memory_entries=64
+    )
+    capture_archive = CaptureArchive(
+        os.path.join('data', 'archive'),
+        segment_bytes=int(os.getenv('ARCHIVE_SEGMENT_BYTES', str(64 * 1024 * 1024))),
+        max_bytes=int(os.getenv('ARCHIVE_MAX_BYTES', str(2 * 1024 * 1024 * 1024))),
+        retention=float(os.getenv('ARCHIVE_RETENTION_DAYS', '90')) * 86400,
+        level=int(os.getenv('ARCHIVE_ZSTD_LEVEL', '6'))
+    )
+    message_registry = MessageRegistry(
+        os.path.join('data', 'messages.db'),
+        retention=float(os.getenv('MESSAGE_RETENTION_DAYS', '180')) * 86400
+    )
+    storage_open = True
+
+def close_storage() -> None:
+    """Flush queued cache writes, captures and registry batches, before shutting down or re-executing the script"""
+    global storage_open
+    if not storage_open:
+        return
+    storage_open = False
+    capture_archive.close()
+    message_registry.close()
+    cache_io.shutdown(wait=True)
+
+async def post_shutdown(application: Any) -> None:
+    await close_http_clients(application)
+    await close_llm_image_pool(application)
+    await asyncio.to_thread(close_storage)
+
+ffmpeg_semaphore = asyncio.Semaphore(int(os.getenv('FFMPEG_CONCURRENCY', '2')))
+
+# Every key of redtoemoji.json is a bracketed token like [笑哭R], matched in one pass and looked up
+redemoji_pattern = re.compile(r'\[[^\[\]]+\]')
 
+def replace_redemoji_with_emoji(text: str) -> str:
+    if '[' not in text:
+        return text
+    return redemoji_pattern.sub(lambda m: redtoemoji.get(m.group(0), m.group(0)), text)
+
+# Endpoints probed when the bot suspects it lost network connectivity
+connectivity_test_urls = [
+    "https://api.telegram.org",
+    "https://www.google.com", 
+    "https://1.1.1.1"
+]
+
+def log_shows_pool_timeouts() -> bool:
+    """Whether the recent log content is full of connection pool timeouts"""
     # Check for pool timeout errors in recent log content
     try:
         with open(logging_file, 'r', encoding='utf-8') as log_str:
@@ -160,11 +897,29 @@ def check_network_connectivity() -> bool:
             pool_timeout_count = sum(1 for pattern in pool_timeout_patterns if pattern in log_content)
             if pool_timeout_count >= 2:
                 bot_logger.warning(f"Detected {pool_timeout_count} pool timeout indicators in recent logs")
-                return False
+                return True
     except Exception as e:
         bot_logger.error(f"Error reading log file: {e}")
+    return False
 
-    for url in test_urls:
+async def check_network_connectivity() -> bool:
+    """Check if network connectivity is available by testing multiple endpoints"""
+    if await asyncio.to_thread(log_shows_pool_timeouts):
+        return False
+    for url in connectivity_test_urls:
+        try:
+            response = await http_get(url, timeout=5)
+            if response.status_code == 200:
+                return True
+        except:
+            continue
+    return False
+
+def check_network_connectivity_sync() -> bool:
+    """Blocking check_network_connectivity, only for the monitor thread and for code running outside the event loop"""
+    if log_shows_pool_timeouts():
+        return False
+    for url in connectivity_test_urls:
         try:
             response = requests.get(url, timeout=5)
             if response.status_code == 200:
@@ -183,7 +938,15 @@ def update_network_status(success: bool = True):
         current_time = time.time()
         if current_time - last_successful_request > network_timeout_threshold:
             is_network_healthy = False
-            bark_notify("xhsfeedbot network is unhealthy.")
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                bark_notify_sync("xhsfeedbot network is unhealthy.")
+            else:
+                # Called from handlers, the notification must not hold up the event loop
+                task = asyncio.create_task(bark_notify("xhsfeedbot network is unhealthy."))
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
 
 def network_monitor():
     """Background network monitoring function"""
@@ -194,7 +957,7 @@ def network_monitor():
             current_time = time.time()
             if current_time - last_successful_request > network_timeout_threshold:
                 bot_logger.warning(f"No successful network requests for {network_timeout_threshold} seconds")
-                if not check_network_connectivity():
+                if not check_network_connectivity_sync():
                     bot_logger.error("Network connectivity test failed - triggering restart")
                     is_network_healthy = False
                     restart_script()
@@ -218,7 +981,7 @@ def scheduled_restart_monitor():
             uptime = time.time() - bot_start_time
             if uptime >= restart_interval_seconds:
                 bot_logger.info(f"Scheduled restart triggered after {uptime/3600:.2f} hours of uptime")
-                bark_notify(f"xhsfeedbot scheduled restart after {uptime/3600:.1f}h uptime")
+                bark_notify_sync(f"xhsfeedbot scheduled restart after {uptime/3600:.1f}h uptime")
                 restart_script()
                 break
         except Exception as e:
@@ -271,9 +1034,9 @@ class Note:
         # self.last_update_time = note_data['data'][0]['note_list'][0]['last_update_time']
         self.comments_with_context: list[dict[str, Any]] = []
         if anchorCommentId:
-            self.comments_with_context = extract_anchor_comment_id(comment_list_data['data'])
+            self.comments_with_context = extract_anchor_comment_id(comment_list_data.get('data', {}))
             bot_logger.debug(f"Comments with context extracted for anchorCommentId {anchorCommentId}:\n{pformat(self.comments_with_context)}")
-        self.comments = extract_all_comments(comment_list_data['data'])
+        self.comments = extract_all_comments(comment_list_data.get('data', {}))
         self.length: int = len(self.desc + self.title)
 
         self.tags: list[str] = [tag['name'] for tag in note_data['data'][0]['note_list'][0]['hash_tag']]
@@ -320,8 +1083,12 @@ class Note:
             self.video_url = note_data['data'][0]['note_list'][0]['video']['url']
             if not re.findall(r'sign=[0-9a-z]+', self.video_url):
                 self.video_url = re.sub(r'[0-9a-z\-]+\.xhscdn\.(com|net)', 'sns-bak-v1.xhscdn.com', self.video_url) #.split('?imageView')[0] + '?imageView2/2/w/5000/h/5000/format/webp/q/56&redImage/frame/0'
+        self.video_file: tempfile.SpooledTemporaryFile[bytes] | None = None
+        self.prefetched: dict[str, asyncio.Task[bytes]] = {}
+        self.video_lock = asyncio.Lock()  # A coalesced note may be sent to several chats at once, they share one video file
+        self.media_group_lock = asyncio.Lock()  # ...and one media group, built by whichever send gets here first
         if telegraph:
-            self.to_html()
+            self.to_nodes()
         tgmsg_result = self.to_telegram_message(preview=bool(self.length >= 666))
         bot_logger.debug(f"tgmsg_result: {tgmsg_result}\nlen: {self.length}, preview? = {bool(self.length >= 666)}")
         media_group_result = self.to_media_group()
@@ -332,6 +1099,32 @@ class Note:
             await self.to_telegraph()
         self.short_preview = ''
 
+    async def prefetch_media(self) -> None:
+        """Start downloading the comment pictures and voices that will be uploaded as bytes, note images go by URL or file_id"""
+        urls: list[str] = []
+        for comment in self.comments_with_context:
+            urls.extend(pic for pic in comment['pictures'] if 'mp4' not in pic)
+            if comment.get('audio_url', '') and not await voice_cache.get(comment['audio_url']):
+                urls.append(comment['audio_url'])
+        for url in urls:
+            if url not in self.prefetched and not await get_file_id(url):
+                task = asyncio.create_task(fetch_media(url))
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())  # Failures surface in media_bytes
+                self.prefetched[url] = task
+
+    async def media_bytes(self, url: str) -> bytes:
+        """Content of an asset, from the prefetch if it was started"""
+        task = self.prefetched.get(url)
+        if task is None:
+            task = self.prefetched[url] = asyncio.create_task(fetch_media(url))
+        try:
+            return await asyncio.shield(task)
+        except httpx.HTTPError:
+            # Don't keep a failed download around, the next send tries again
+            if self.prefetched.get(url) is task:
+                del self.prefetched[url]
+            raise
+
     def to_dict(self) -> dict[str, str | int | Any]:
         return {
             'user': self.user,
@@ -356,82 +1149,95 @@ class Note:
             if not img['live']:
                 media_list.append({
                     'type': 'image',
-                    'url': img['url']
+                    'url': img['url'],
+                    'file': llm_media_path(img['url'])
                 })
         # For video notes, use the thumbnail image instead of the full video
         if self.video_url and self.thumbnail:
             media_list.append({
                 'type': 'image',
-                'url': self.thumbnail
+                'url': self.thumbnail,
+                'file': llm_media_path(self.thumbnail)
             })
         return media_list
 
-    def to_html(self) -> str:
-        html = ''
-        html += f'<h3><a href="{self.url}">{self.title}</a></h3>' if self.title else ''
+    async def prepare_llm_media(self) -> None:
+        """Build the LLM derivatives of the note images ahead of any AI summary request"""
+        async def prepare(media: dict[str, str]) -> None:
+            if os.path.exists(media['file']):
+                return
+            try:
+                await build_llm_derivative(media['url'], await self.media_bytes(media['url']))
+            except Exception as e:
+                bot_logger.warning(f"Failed to build LLM image for {media['url']}: {e}")
+        await asyncio.gather(*(prepare(media) for media in self.media_for_llm()))
+
+    def to_nodes(self) -> list[Any]:
+        """Telegraph page content as a node tree, sent as is so nothing has to be rendered to HTML and parsed back"""
+        xsec_query = f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""
+        xsec_param = f"&xsec_token={self.xsec_token}" if self.with_xsec_token else ""
+        nodes: list[Any] = []
+        append = nodes.append
+        if self.title:
+            append(telegraph_node('h3', telegraph_node('a', telegraph_text(self.title), href=self.url)))
         for img in self.images_list:
-            if not img['live']:
-                html += f'<img src="{img["url"]}"></img>'
-            else:
-                html += f'<video src="{img["url"]}"></video>'
+            append(telegraph_node('video' if img['live'] else 'img', src=img['url']))
         if self.video_url:
-            html += f'<video src="{self.video_url}"></video>'
-        for lines in self.desc.split('\n'):
-            line_html = tg_msg_escape_html(lines)
-            html += f'<blockquote>{line_html}</blockquote>'
-        html += f'<h4>👤 <a href="https://www.xiaohongshu.com/user/profile/{self.user["id"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""}"> @{self.user["name"]} ({self.user.get("red_id", "")})</a></h4>'
-        html += f'<img src="{self.user["image"]}"></img>'
-        html += f'<p>{get_time_emoji(self.time)} {convert_timestamp_to_timestr(self.time)}</p>'
-        html += f'<p>❤️ {self.liked_count} ⭐ {self.collected_count} 💬 {self.comments_count} 🔗 {self.shared_count}</p>'
-        if hasattr(self, 'ip_location'):
-            ipaddr_html = tg_msg_escape_html(self.ip_location)
-        else:
-            ipaddr_html = '?'
-        html += f'<p>📍 {ipaddr_html}</p>'
-        html += f'<blockquote><a href="{self.url}">Source</a></blockquote>'
-        if self.comments:
-            html += '<hr>'
-            for i, comment in enumerate(self.comments):
-                html += f'<h4>💬 <a href="https://www.xiaohongshu.com/discovery/item/{self.noteId}?anchorCommentId={comment["id"]}{f"&xsec_token={self.xsec_token}" if self.with_xsec_token else ""}">Comment</a></h4>'
-                if 'target_comment' in comment:
-                    html += f'<p>↪️ <a href="https://www.xiaohongshu.com/user/profile/{comment["target_comment"]["user"]["userid"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""}"> {'@' + comment["target_comment"]["user"].get("nickname", "")} ({comment["target_comment"]["user"].get('red_id', '')})</a></p>'
-                html += f'<p>{tg_msg_escape_html(replace_redemoji_with_emoji(comment["content"]))}</p>'
-                for pic in comment['pictures']:
-                    if 'mp4' in pic:
-                        html += f'<video src="{pic}"></video>'
-                    else:
-                        html += f'<img src="{pic}"></img>'
-                if comment.get('audio_url', ''):
-                    html += f'<p><a href="{comment["audio_url"]}">🎤 Voice</a></p>'
-                html += f'<p>❤️ {comment["like_count"]} 💬 {comment["sub_comment_count"]}<br>📍 {tg_msg_escape_html(comment["ip_location"])}<br>{get_time_emoji(comment["time"])} {convert_timestamp_to_timestr(comment["time"])}</p>'
-                html += f'<p>👤 <a href="https://www.xiaohongshu.com/user/profile/{comment["user"]["userid"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""}"> {'@' + comment["user"].get("nickname", "")} ({comment["user"].get("red_id", "")})</a></p>'
-                for sub_comment in comment.get('sub_comments', []):
-                    html += '<blockquote><blockquote>'
-                    html += f'<h4>💬 <a href="https://www.xiaohongshu.com/discovery/item/{self.noteId}?anchorCommentId={sub_comment["id"]}{f"&xsec_token={self.xsec_token}" if self.with_xsec_token else ""}">Comment</a></h4>'
-                    if 'target_comment' in sub_comment:
-                        html += f'<br><p>  ↪️  <a href="https://www.xiaohongshu.com/user/profile/{sub_comment["target_comment"]["user"]["userid"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""}"> {'@' + sub_comment["target_comment"]["user"].get("nickname", "")} ({sub_comment["target_comment"]["user"].get("red_id", "")})</a></p>'
-                    html += f'<br><p>{tg_msg_escape_html(replace_redemoji_with_emoji(sub_comment["content"]))}</p>'
-                    for pic in sub_comment['pictures']:
-                        if 'mp4' in pic:
-                            html += f'<br><video src="{pic}"></video>'
-                        else:
-                            html += f'<br><img src="{pic}"></img>'
-                    if sub_comment.get('audio_url', ''):
-                        html += f'<br><p><a href="{sub_comment["audio_url"]}">🎤 Voice</a></p>'
-                    html += f'<br><p>❤️ {sub_comment["like_count"]} 💬 {sub_comment["sub_comment_count"]}<br>📍 {tg_msg_escape_html(sub_comment["ip_location"])}<br>{get_time_emoji(sub_comment["time"])} {convert_timestamp_to_timestr(sub_comment["time"])}</p>'
-                    html += f'<br><p>👤 <a href="https://www.xiaohongshu.com/user/profile/{sub_comment["user"]["userid"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""}"> {'@' + sub_comment["user"].get("nickname", "")} ({sub_comment["user"].get("red_id", "")})</a></p>'
-                    html += '</blockquote></blockquote>'
-                if i != len(self.comments) - 1:
-                    html += f'<hr>'
-        self.html = html
-        bot_logger.debug(f"HTML generated, \n\n{self.html}\n\n")
-        return self.html
+            append(telegraph_node('video', src=self.video_url))
+        for line in self.desc.split('\n'):
+            append(telegraph_node('blockquote', telegraph_text(line)))
+        append(telegraph_node(
+            'h4', '👤 ',
+            telegraph_node('a', telegraph_text(f'@{self.user["name"]} ({self.user.get("red_id", "")})'), href=f'https://www.xiaohongshu.com/user/profile/{self.user["id"]}{xsec_query}')
+        ))
+        append(telegraph_node('img', src=self.user['image']))
+        append(telegraph_node('p', f'{get_time_emoji(self.time)} {convert_timestamp_to_timestr(self.time)}'))
+        append(telegraph_node('p', f'❤️ {self.liked_count} ⭐ {self.collected_count} 💬 {self.comments_count} 🔗 {self.shared_count}'))
+        append(telegraph_node('p', telegraph_text(f'📍 {self.ip_location if hasattr(self, "ip_location") else "?"}')))
+        append(telegraph_node('blockquote', telegraph_node('a', 'Source', href=self.url)))
+        for i, comment in enumerate(self.comments):
+            append(telegraph_node('hr'))
+            append(telegraph_node('h4', '💬 ', telegraph_node('a', 'Comment', href=f'https://www.xiaohongshu.com/discovery/item/{self.noteId}?anchorCommentId={comment["id"]}{xsec_param}')))
+            nodes.extend(self.comment_nodes(comment, xsec_query))
+            for sub_comment in comment.get('sub_comments', []):
+                reply: list[Any] = [telegraph_node('h4', '💬 ', telegraph_node('a', 'Comment', href=f'https://www.xiaohongshu.com/discovery/item/{self.noteId}?anchorCommentId={sub_comment["id"]}{xsec_param}'))]
+                for node in self.comment_nodes(sub_comment, xsec_query):
+                    reply.append(telegraph_node('br'))
+                    reply.append(node)
+                append(telegraph_node('blockquote', telegraph_node('blockquote', *reply)))
+        self.nodes = nodes
+        bot_logger.debug(f"Telegraph nodes generated for {len(self.comments)} comments")
+        return self.nodes
+
+    def comment_nodes(self, comment: dict[str, Any], xsec_query: str) -> list[Any]:
+        nodes: list[Any] = []
+        if 'target_comment' in comment:
+            target_user = comment["target_comment"]["user"]
+            nodes.append(telegraph_node(
+                'p', '↪️ ',
+                telegraph_node('a', telegraph_text(f'@{target_user.get("nickname", "")} ({target_user.get("red_id", "")})'), href=f'https://www.xiaohongshu.com/user/profile/{target_user["userid"]}{xsec_query}')
+            ))
+        nodes.append(telegraph_node('p', telegraph_text(comment["content"])))
+        for pic in comment['pictures']:
+            nodes.append(telegraph_node('video' if 'mp4' in pic else 'img', src=pic))
+        if comment.get('audio_url', ''):
+            nodes.append(telegraph_node('p', telegraph_node('a', '🎤 Voice', href=comment['audio_url'])))
+        nodes.append(telegraph_node(
+            'p',
+            f'❤️ {comment["like_count"]} 💬 {comment["sub_comment_count"]}',
+            telegraph_node('br'),
+            telegraph_text(f'📍 {comment["ip_location"]}'),
+            telegraph_node('br'),
+            f'{get_time_emoji(comment["time"])} {convert_timestamp_to_timestr(comment["time"])}'
+        ))
+        nodes.append(telegraph_node(
+            'p', '👤 ',
+            telegraph_node('a', telegraph_text(f'@{comment["user"].get("nickname", "")} ({comment["user"].get("red_id", "")})'), href=f'https://www.xiaohongshu.com/user/profile/{comment["user"]["userid"]}{xsec_query}')
+        ))
+        return nodes
 
     def __str__(self) -> str:
         self.content = '笔记标题：' + self.title + '\n' + '笔记正文：' + self.desc
-        for img in self.images_list:
-            if not img['live']:
-                img = requests.get(img["url"]).content # TODO image to base64?
         self.content += f'\n发布者：@{self.user["name"]} ({self.user.get('red_id', '')})\n'
         self.content += f'{get_time_emoji(self.time)} {convert_timestamp_to_timestr(self.time)}\n'
         self.content += f'点赞：{self.liked_count}收藏：{self.collected_count}评论：{self.comments_count}分享：{self.shared_count}\n'
@@ -447,7 +1253,7 @@ class Note:
                     self.content += f'💬 评论\n'
                     # if 'target_comment' in comment:
                     #     self.content += f'↪️ @{comment["target_comment"]["user"].get("nickname", "")} ({comment["target_comment"]["user"].get('red_id', '')})\n'
-                    self.content += f'{tg_msg_escape_html(replace_redemoji_with_emoji(comment["content"]))}\n'
+                    self.content += f'{tg_msg_escape_html(comment["content"])}\n'
                     self.content += f'点赞：{comment["like_count"]}\nIP 地址：{tg_msg_escape_html(comment["ip_location"])}\n{get_time_emoji(comment["time"])} {convert_timestamp_to_timestr(comment["time"])}\n'
                     # self.content += f'发布者：@{comment["user"].get("nickname", "")} ({comment["user"].get('red_id', '')})\n'
                 for sub_comment in comment.get('sub_comments', []):
@@ -455,7 +1261,7 @@ class Note:
                         self.content += f'💬 回复\n'
                         # if 'target_comment' in sub_comment:
                             # self.content += f'↪️ @{sub_comment["target_comment"]["user"].get("nickname", "")} ({sub_comment["target_comment"]["user"].get('red_id', '')})\n'
-                        self.content += f'{tg_msg_escape_html(replace_redemoji_with_emoji(sub_comment["content"]))}\n'
+                        self.content += f'{tg_msg_escape_html(sub_comment["content"])}\n'
                         self.content += f'点赞：{sub_comment["like_count"]}\nIP 地址：{tg_msg_escape_html(sub_comment["ip_location"])}\n{get_time_emoji(sub_comment["time"])} {convert_timestamp_to_timestr(sub_comment["time"])}\n'
                         # self.content += f'发布者：@{sub_comment["user"].get("nickname", "")} ({sub_comment["user"].get('red_id', '')})\n'
                 if i != len(self.comments) - 1:
@@ -464,20 +1270,46 @@ class Note:
         return self.content
 
     async def to_telegraph(self) -> str:
-        if not hasattr(self, 'html'):
-            self.to_html()
+        if not hasattr(self, 'nodes'):
+            self.to_nodes()
         if not self.telegraph_account:
             self.telegraph_account = Telegraph()
             await self.telegraph_account.create_account( # type: ignore
                 short_name='@xhsfeedbot',
             )
-        response = await self.telegraph_account.create_page( # type: ignore
-            title=f"{self.title} @{self.user['name']}",
-            author_name=f'@{self.user["name"]} ({self.user.get('red_id', '')})',
-            author_url=f"https://www.xiaohongshu.com/user/profile/{self.user['id']}",
-            html_content=self.html,
-        )
-        self.telegraph_url = response['url']
+        page: dict[str, Any] = {
+            'title': f"{self.title} @{self.user['name']}",
+            'author_name': f'@{self.user["name"]} ({self.user.get('red_id', '')})',
+            'author_url': f"https://www.xiaohongshu.com/user/profile/{self.user['id']}",
+            'content': self.nodes,
+        }
+        page_hash = hashlib.sha256(json.dumps(page, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+        cache_key = f'{self.noteId}.{"x" if self.with_xsec_token else "n"}'
+        published = await telegraph_pages.get(cache_key)
+        if published and published['hash'] == page_hash:
+            self.telegraph_url = published['url']
+            bot_logger.debug(f"Reused Telegraph URL: {self.telegraph_url}")
+            return self.telegraph_url
+        response: dict[str, Any] | None = None
+        if published:
+            # Pages can only be edited by the account that created them, a page of an earlier account is recreated
+            try:
+                response = await self.telegraph_account.edit_page( # type: ignore
+                    path=published['path'],
+                    **page
+                )
+                record_metric('telegraph.edited')
+            except Exception as e:
+                bot_logger.warning(f"Failed to edit Telegraph page {published['path']}, creating a new one: {e}")
+        if not response:
+            response = await self.telegraph_account.create_page(**page) # type: ignore
+            record_metric('telegraph.created')
+        self.telegraph_url = response['url'] # type: ignore
+        telegraph_pages.set(cache_key, {
+            'path': response['path'], # type: ignore
+            'url': self.telegraph_url,
+            'hash': page_hash,
+        })
         bot_logger.debug(f"Generated Telegraph URL: {self.telegraph_url}")
         return self.telegraph_url
 
@@ -525,46 +1357,203 @@ class Note:
 
     async def to_media_group(self) -> list[list[InputMediaPhoto | InputMediaVideo]]:
         self.medien: list[InputMediaPhoto | InputMediaVideo] = []
+        self.medien_sources: list[str] = []  # Source URL of each media, to remember its file_id once sent
         self.video_too_large = False  # Flag to track if video is too large
         for _, imgs in enumerate(self.images_list):
             if not imgs['live']:
                 self.medien.append(
-                    InputMediaPhoto(imgs['url'])
+                    InputMediaPhoto(await get_file_id(imgs['url']) or imgs['url'])
                 )
+                self.medien_sources.append(imgs['url'])
             # else:
             #     self.medien.append(
             #         InputMediaVideo(
             #             requests.get(imgs['url']).content
             #         )
             #     )
-        if self.video_url:
-            # Check video size before downloading
+        video_file_id = await get_file_id(self.video_url) if self.video_url else None
+        if video_file_id:
+            # Already uploaded once, no need to download it again
+            self.medien = [InputMediaVideo(video_file_id)]
+            self.medien_sources = [self.video_url]
+        elif self.video_url:
             try:
-                head_response = requests.head(self.video_url, timeout=10)
-                content_length = head_response.headers.get('Content-Length', '0')
-                video_size_mb = int(content_length) / (1024 * 1024)  # Convert to MB
-                
-                bot_logger.info(f"Video size: {video_size_mb:.2f}MB")
-                
-                if video_size_mb > 50:
-                    bot_logger.warning(f"Video size {video_size_mb:.2f}MB exceeds 50MB limit, skipping video upload")
+                if await self.download_video():
+                    self.medien = [InputMediaVideo(self.video_input_file())]
+                    self.medien_sources = [self.video_url]
+                else:
                     self.video_too_large = True
                     self.medien = []  # Clear medien to send text only
-                else:
-                    # Only download if size is acceptable
-                    video_data = requests.get(self.video_url).content
-                    self.medien = [InputMediaVideo(video_data)]
             except Exception as e:
                 bot_logger.error(f"Failed to check video size: {e}, skipping video")
                 self.video_too_large = True
                 self.medien = []
         self.medien_parts = [self.medien[i:i + 10] for i in range(0, len(self.medien), 10)]
+        self.medien_sources_parts = [self.medien_sources[i:i + 10] for i in range(0, len(self.medien_sources), 10)]
         return self.medien_parts
 
+    async def prepare_comment(self, comment: dict[str, Any]) -> dict[str, Any]:
+        """Render a comment and get its pictures or voice ready, everything but the send itself"""
+        comment_text = ''
+        comment_text += f'💬 [Comment](https://www.xiaohongshu.com/discovery/item/{self.noteId}?anchorCommentId={comment["id"]}{f"&xsec_token={self.xsec_token}" if self.with_xsec_token else ""})'
+        if 'target_comment' in comment:
+            comment_text += f'\n↪️ [@{tg_msg_escape_markdown_v2(comment["target_comment"]["user"].get("nickname", ""))} \\({tg_msg_escape_markdown_v2(comment["target_comment"]["user"].get('red_id', ''))}\\)](https://www.xiaohongshu.com/user/profile/{comment["target_comment"]["user"]["userid"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""})\n'
+        else:
+            comment_text += '\n'
+        comment_text += f'{make_block_quotation(comment["content"])}\n'
+        comment_text += f'❤️ {comment["like_count"]} 💬 {comment["sub_comment_count"]} 📍 {tg_msg_escape_markdown_v2(comment["ip_location"])} {get_time_emoji(comment["time"])} {tg_msg_escape_markdown_v2(convert_timestamp_to_timestr(comment["time"]))}\n'
+        comment_text += f'👤 [@{tg_msg_escape_markdown_v2(comment["user"].get("nickname", ""))} \\({tg_msg_escape_markdown_v2(comment["user"].get('red_id', ''))}\\)](https://www.xiaohongshu.com/user/profile/{comment["user"]["userid"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""})'
+        payload: dict[str, Any] = {'text': comment_text, 'chunks': [], 'voice': None}
+        try:
+            if comment['pictures']:
+                # Split pictures into chunks of 10, the caption goes with the last one
+                for i in range(0, len(comment['pictures']), 10):
+                    media: list[InputMediaPhoto | InputMediaVideo] = []
+                    media_sources: list[str] = []
+                    for pic in comment['pictures'][i:i + 10]:
+                        if 'mp4' not in pic:
+                            file_id = await get_file_id(pic)
+                            media.append(InputMediaPhoto(file_id if file_id else await self.media_bytes(pic)))
+                            media_sources.append(pic)
+                    payload['chunks'].append((media, media_sources))
+            elif comment.get('audio_url', ''):
+                payload['voice'] = await get_file_id(comment['audio_url']) or await self.voice_bytes(comment['audio_url'])
+        except Exception as e:
+            # Still send the text, later comments may reply to this one
+            bot_logger.error(f"Failed to prepare media of comment {comment['id']}, sending text only: {e}")
+            record_metric('comments.media_failed')
+            payload['chunks'] = []
+            payload['voice'] = None
+        return payload
+
+    async def voice_bytes(self, audio_url: str) -> bytes:
+        """Ogg/Opus version of a voice comment, concurrent requests for the same clip share one conversion"""
+        cached = await voice_cache.get(audio_url)
+        if cached:
+            return base64.b64decode(cached)
+        task = voice_conversions.get(audio_url)
+        if task is None:
+            task = voice_conversions[audio_url] = asyncio.create_task(self.convert_voice(audio_url))
+            task.add_done_callback(lambda t: voice_conversion_done(audio_url, t))
+        return await asyncio.shield(task)
+
+    async def convert_voice(self, audio_url: str) -> bytes:
+        voice = await convert_to_ogg_opus(await self.media_bytes(audio_url))
+        voice_cache.set(audio_url, base64.b64encode(voice).decode())
+        return voice
+
+    def video_input_file(self) -> InputFile:
+        """Upload the spooled video from its start, streamed from the handle rather than read into memory"""
+        assert self.video_file is not None
+        self.video_file.seek(0)
+        return InputFile(self.video_file, filename='video.mp4', attach=True, read_file_handle=False)
+
+    async def download_video(self) -> bool:
+        """Spool the video for upload, False if it is over the 50MB upload limit"""
+        # Check video size before downloading
+        head_response = await http_request('HEAD', self.video_url)
+        content_length = head_response.headers.get('Content-Length', '0')
+        video_size_mb = int(content_length) / (1024 * 1024)  # Convert to MB
+        bot_logger.info(f"Video size: {video_size_mb:.2f}MB")
+        if video_size_mb > 50:
+            bot_logger.warning(f"Video size {video_size_mb:.2f}MB exceeds 50MB limit, skipping video upload")
+            return False
+        # Only download if size is acceptable, straight into a spooled file
+        self.video_file = await download_to_spool(
+            self.video_url,
+            size=int(content_length),
+            accept_ranges=head_response.headers.get('Accept-Ranges', '') == 'bytes'
+        )
+        return True
+
+    async def send_video(self, bot: Bot, chat_id: int, reply_to_message_id: int, caption_text: str) -> Sequence[Message]:
+        async with self.video_lock:
+            video: str | InputFile | None = await get_file_id(self.video_url)
+            if not video:
+                # Only had a file_id and it went stale, fetch the video after all unless it is too large to upload
+                if self.video_file is None and not await self.download_video():
+                    self.video_too_large = True
+                    return [await bot.send_message(
+                        chat_id=chat_id,
+                        text=caption_text,
+                        parse_mode=ParseMode.MARKDOWN_V2,
+                        reply_to_message_id=reply_to_message_id,
+                        disable_notification=True,
+                        link_preview_options=LinkPreviewOptions(is_disabled=True)
+                    )]
+                video = self.video_input_file()
+            sent_message = await bot.send_media_group(
+                chat_id=chat_id,
+                reply_to_message_id=reply_to_message_id,
+                media=[InputMediaVideo(video, caption=caption_text, parse_mode=ParseMode.MARKDOWN_V2)],
+                disable_notification=True
+            )
+            remember_file_ids([self.video_url], sent_message)
+            return sent_message
+
+    async def send_comment_media(self, bot: Bot, chat_id: int, reply_to_message_id: int, media: list[InputMediaPhoto | InputMediaVideo], media_sources: list[str], caption_text: str = '') -> Sequence[Message]:
+        """Send a chunk of comment pictures, uploaded again if Telegram rejects one of the cached file_ids"""
+        caption: dict[str, Any] = {'caption': caption_text, 'parse_mode': ParseMode.MARKDOWN_V2} if caption_text else {}
+        try:
+            sent_messages = await bot.send_media_group(
+                chat_id=chat_id,
+                reply_to_message_id=reply_to_message_id,
+                media=media,
+                disable_notification=True,
+                **caption
+            )
+        except BadRequest as e:
+            if not any(type(m.media) == str for m in media):
+                raise
+            bot_logger.warning(f"Cached comment pictures rejected, uploading them again: {e}")
+            record_metric('file_id.stale')
+            for source in media_sources:
+                telegram_files.delete(remove_image_url_params(source))
+            sent_messages = await bot.send_media_group(
+                chat_id=chat_id,
+                reply_to_message_id=reply_to_message_id,
+                media=[InputMediaPhoto(await self.media_bytes(source)) for source in media_sources],
+                disable_notification=True,
+                **caption
+            )
+        remember_file_ids(media_sources, sent_messages)
+        return sent_messages
+
+    async def send_comment_voice(self, bot: Bot, chat_id: int, reply_to_message_id: int, audio_url: str, voice: str | bytes, caption_text: str) -> Message:
+        """Send a voice comment, converted and uploaded again if Telegram rejects the cached file_id"""
+        try:
+            sent_message = await bot.send_voice(
+                chat_id=chat_id,
+                voice=voice,
+                reply_to_message_id=reply_to_message_id,
+                caption=caption_text,
+                parse_mode=ParseMode.MARKDOWN_V2,
+                disable_notification=True
+            )
+        except BadRequest as e:
+            if type(voice) != str:
+                raise
+            bot_logger.warning(f"Cached voice {audio_url} rejected, uploading it again: {e}")
+            record_metric('file_id.stale')
+            telegram_files.delete(remove_image_url_params(audio_url))
+            sent_message = await bot.send_voice(
+                chat_id=chat_id,
+                voice=await self.voice_bytes(audio_url),
+                reply_to_message_id=reply_to_message_id,
+                caption=caption_text,
+                parse_mode=ParseMode.MARKDOWN_V2,
+                disable_notification=True
+            )
+        remember_file_ids([audio_url], [sent_message])
+        return sent_message
+
     async def send_as_telegram_message(self, bot: Bot, chat_id: int, reply_to_message_id: int = 0) -> None:
         sent_message = None
-        if not hasattr(self, 'medien_parts'):
-            self.medien_parts: list[list[InputMediaPhoto | InputMediaVideo]] = await self.to_media_group()
+        # Comment media downloads overlap with the video download and the note message
+        await self.prefetch_media()
+        async with self.media_group_lock:
+            if not hasattr(self, 'medien_parts'):
+                self.medien_parts: list[list[InputMediaPhoto | InputMediaVideo]] = await self.to_media_group()
         
         # Prepare caption for media group
         caption_text = self.message if hasattr(self, 'message') else await self.to_telegram_message(preview=bool(self.length >= 666))
@@ -597,16 +1586,7 @@ class Note:
                         part[0] = InputMediaPhoto(part[0].media, caption=caption_text, parse_mode=ParseMode.MARKDOWN_V2) if isinstance(part[0], InputMediaPhoto) else InputMediaVideo(part[0].media, caption=caption_text, parse_mode=ParseMode.MARKDOWN_V2)
                     
                     if self.video_url:
-                        # Add caption to video
-                        video_media = self.medien[-1:]
-                        if video_media and i == 0:
-                            video_media[0] = InputMediaVideo(video_media[0].media, caption=caption_text, parse_mode=ParseMode.MARKDOWN_V2)
-                        sent_message = await bot.send_media_group(
-                            chat_id=chat_id,
-                            reply_to_message_id=reply_to_message_id,
-                            media=video_media,
-                            disable_notification=True
-                        )
+                        sent_message = await self.send_video(bot, chat_id, reply_to_message_id, caption_text)
                     else:
                         sent_message = await bot.send_media_group(
                             chat_id=chat_id,
@@ -614,36 +1594,33 @@ class Note:
                             media=part,
                             disable_notification=True
                         )
+                        remember_file_ids(self.medien_sources_parts[i], sent_message)
                 except:
                     bot_logger.error(f"Failed to send media group:\n{traceback.format_exc()}")
-                    media: list[InputMediaPhoto | InputMediaVideo] = []
-                    for j, p in enumerate(part):
-                        if type(p.media) == str and '.mp4' not in p.media:
-                            media_content = requests.get(p.media).content
+                    # Forget file_ids of this part in case one of them went stale
+                    for source in self.medien_sources_parts[i]:
+                        telegram_files.delete(remove_image_url_params(source))
+                    if self.video_url:
+                        # send_video downloads the video again only after the same size check
+                        sent_message = await self.send_video(bot, chat_id, reply_to_message_id, caption_text)
+                    else:
+                        # Upload from the source URLs, the cached file_id may be the one that failed
+                        # Note images are fetched here on demand, all of the part at once under the per-host limit
+                        contents = await asyncio.gather(*(self.media_bytes(source) for source in self.medien_sources_parts[i]))
+                        media: list[InputMediaPhoto | InputMediaVideo] = []
+                        for j, media_content in enumerate(contents):
                             # Add caption to first media item in retry
                             if j == 0 and i == 0:
                                 media.append(InputMediaPhoto(media_content, caption=caption_text, parse_mode=ParseMode.MARKDOWN_V2))
                             else:
                                 media.append(InputMediaPhoto(media_content))
-                        elif self.video_url and type(p.media) != str:
-                            media.append(p)
-                    if self.video_url:
-                        video_media = self.medien[-1:]
-                        if video_media and i == 0:
-                            video_media[0] = InputMediaVideo(video_media[0].media, caption=caption_text, parse_mode=ParseMode.MARKDOWN_V2)
-                        sent_message = await bot.send_media_group(
-                            chat_id=chat_id,
-                            reply_to_message_id=reply_to_message_id,
-                            media=video_media,
-                            disable_notification=True
-                        )
-                    else:
                         sent_message = await bot.send_media_group(
                             chat_id=chat_id,
                             reply_to_message_id=reply_to_message_id,
                             media=media,
                             disable_notification=True
                         )
+                        remember_file_ids(self.medien_sources_parts[i], sent_message)
         
         if not sent_message:
             bot_logger.error("No message was sent!")
@@ -651,103 +1628,108 @@ class Note:
         
         # Store note content and media for AI summary on reaction
         try:
-            msg_identifier = f"{chat_id}.{sent_message[0].message_id}"
-            msg_data = {
+            message_registry.put(chat_id, sent_message[0].message_id, {
                 'content': str(self),
                 'media': self.media_for_llm()
-            }
-            msg_file_path = os.path.join('data', f'{msg_identifier}.json')
-            with open(msg_file_path, 'w', encoding='utf-8') as f:
-                json.dump(msg_data, f, indent=4, ensure_ascii=False)
-            bot_logger.debug(f"Saved message data to {msg_file_path} for AI summary")
+            })
+            bot_logger.debug(f"Registered message {chat_id}.{sent_message[0].message_id} for AI summary")
         except Exception as e:
             bot_logger.error(f"Failed to save message data: {e}")
+        task = asyncio.create_task(self.prepare_llm_media())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
         
         reply_id = sent_message[0].message_id
         comment_id_to_message_id: dict[str, Any] = {}
         if self.comments_with_context:
-            for _, comment in enumerate(self.comments_with_context):
-                comment_text = ''
-                comment_text += f'💬 [Comment](https://www.xiaohongshu.com/discovery/item/{self.noteId}?anchorCommentId={comment["id"]}{f"&xsec_token={self.xsec_token}" if self.with_xsec_token else ""})'
-                if 'target_comment' in comment:
-                    comment_text += f'\n↪️ [@{tg_msg_escape_markdown_v2(comment["target_comment"]["user"].get("nickname", ""))} \\({tg_msg_escape_markdown_v2(comment["target_comment"]["user"].get('red_id', ''))}\\)](https://www.xiaohongshu.com/user/profile/{comment["target_comment"]["user"]["userid"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""})\n'
-                else:
-                    comment_text += '\n'
-                comment_text += f'{make_block_quotation(replace_redemoji_with_emoji(comment["content"]))}\n'
-                comment_text += f'❤️ {comment["like_count"]} 💬 {comment["sub_comment_count"]} 📍 {tg_msg_escape_markdown_v2(comment["ip_location"])} {get_time_emoji(comment["time"])} {tg_msg_escape_markdown_v2(convert_timestamp_to_timestr(comment["time"]))}\n'
-                comment_text += f'👤 [@{tg_msg_escape_markdown_v2(comment["user"].get("nickname", ""))} \\({tg_msg_escape_markdown_v2(comment["user"].get('red_id', ''))}\\)](https://www.xiaohongshu.com/user/profile/{comment["user"]["userid"]}{f"?xsec_token={self.xsec_token}" if self.with_xsec_token else ""})'
-                bot_logger.debug(f"Sending comment:\n{comment_text}")
-                if 'target_comment' in comment and _ > 0:
-                    reply_id = comment_id_to_message_id[comment['target_comment']['id']].message_id
-                if comment['pictures']:
-                    await bot.send_chat_action(
-                        chat_id=chat_id,
-                        action=ChatAction.UPLOAD_PHOTO
-                    )
-                    # 1. Split pictures into chunks of 10
-                    picture_chunks = [comment['pictures'][i:i + 10] for i in range(0, len(comment['pictures']), 10)]
-                    for i, chunk in enumerate(picture_chunks):
-                        media: list[InputMediaPhoto | InputMediaVideo] = []
-                        for pic in chunk:
-                            if 'mp4' not in pic:
-                                media_data = requests.get(pic).content
-                                media.append(InputMediaPhoto(media_data))
-                        # 2. Check if this is the LAST chunk
-                        if i == len(picture_chunks) - 1:
-                            # Send the last chunk WITH the caption
-                            sent_messages = await bot.send_media_group(
-                                chat_id=chat_id,
-                                reply_to_message_id=reply_id,
-                                media=media,
-                                caption=comment_text,
-                                parse_mode=ParseMode.MARKDOWN_V2,
-                                disable_notification=True
-                            )
-                            # 3. Store ONLY the first message object so .message_id works later
-                            comment_id_to_message_id[comment['id']] = sent_messages[0]
-                        else:
-                            # Send intermediate chunks WITHOUT caption
-                            await bot.send_media_group(
-                                chat_id=chat_id,
-                                reply_to_message_id=reply_id,
-                                media=media,
-                                disable_notification=True
-                            )
-                elif comment.get('audio_url', ''):
-                    await bot.send_chat_action(
-                        chat_id=chat_id,
-                        action=ChatAction.RECORD_VOICE
-                    )
-                    # Download audio
-                    r = requests.get(comment['audio_url'])
-                    audio_bytes = r.content
-
-                    # Convert to Ogg/Opus
-                    ogg_bytes = convert_to_ogg_opus_pipe(audio_bytes)
-                    comment_id_to_message_id[comment['id']] = await bot.send_voice(
-                        chat_id=chat_id,
-                        voice=ogg_bytes,
-                        reply_to_message_id=reply_id,
-                        caption=comment_text,
-                        parse_mode=ParseMode.MARKDOWN_V2,
-                        disable_notification=True
-                    )
-                else:
-                    await bot.send_chat_action(
-                        chat_id=chat_id,
-                        action=ChatAction.TYPING
-                    )
-                    comment_id_to_message_id[comment['id']] = await bot.send_message(
-                        chat_id=chat_id,
-                        reply_to_message_id=reply_id,
-                        text=comment_text,
-                        parse_mode=ParseMode.MARKDOWN_V2,
-                        disable_web_page_preview=True,
-                        disable_notification=True
-                    )
-
-def get_redirected_url(url: str) -> str:
-    return unquote(requests.get(url if 'http' in url else f'http://{url}').url.split("redirectPath=")[-1])
+            # Prepare all comments at once, only the sends wait for each other since replies need message ids
+            prepared = [asyncio.create_task(self.prepare_comment(comment)) for comment in self.comments_with_context]
+            try:
+                for _, comment in enumerate(self.comments_with_context):
+                    try:
+                        payload = await prepared[_]
+                    except Exception as e:
+                        bot_logger.error(f"Failed to prepare comment {comment['id']}, skipping it: {e}")
+                        continue
+                    comment_text = payload['text']
+                    bot_logger.debug(f"Sending comment:\n{comment_text}")
+                    if 'target_comment' in comment and _ > 0 and comment['target_comment']['id'] in comment_id_to_message_id:
+                        reply_id = comment_id_to_message_id[comment['target_comment']['id']].message_id
+                    if payload['chunks']:
+                        await bot.send_chat_action(
+                            chat_id=chat_id,
+                            action=ChatAction.UPLOAD_PHOTO
+                        )
+                        for i, (media, media_sources) in enumerate(payload['chunks']):
+                            # Check if this is the LAST chunk
+                            if i == len(payload['chunks']) - 1:
+                                # Send the last chunk WITH the caption
+                                sent_messages = await self.send_comment_media(bot, chat_id, reply_id, media, media_sources, comment_text)
+                                # Store ONLY the first message object so .message_id works later
+                                comment_id_to_message_id[comment['id']] = sent_messages[0]
+                            else:
+                                # Send intermediate chunks WITHOUT caption
+                                await self.send_comment_media(bot, chat_id, reply_id, media, media_sources)
+                    elif payload['voice']:
+                        await bot.send_chat_action(
+                            chat_id=chat_id,
+                            action=ChatAction.RECORD_VOICE
+                        )
+                        comment_id_to_message_id[comment['id']] = await self.send_comment_voice(
+                            bot, chat_id, reply_id, comment['audio_url'], payload['voice'], comment_text
+                        )
+                    else:
+                        await bot.send_chat_action(
+                            chat_id=chat_id,
+                            action=ChatAction.TYPING
+                        )
+                        comment_id_to_message_id[comment['id']] = await bot.send_message(
+                            chat_id=chat_id,
+                            reply_to_message_id=reply_id,
+                            text=comment_text,
+                            parse_mode=ParseMode.MARKDOWN_V2,
+                            disable_web_page_preview=True,
+                            disable_notification=True
+                        )
+            finally:
+                for task in prepared:
+                    task.cancel()
+                # Retrieve what the cancelled or failed preparations ended with
+                await asyncio.gather(*prepared, return_exceptions=True)
+
+
+async def get_file_id(url: str) -> str | None:
+    """Get the Telegram file_id of media already uploaded from this URL"""
+    return await telegram_files.get(remove_image_url_params(url))
+
+def remember_file_ids(sources: list[str], messages: Sequence[Message]) -> None:
+    for source, message in zip(sources, messages):
+        if message.photo:
+            file_id = message.photo[-1].file_id
+        elif message.video:
+            file_id = message.video.file_id
+        elif message.voice:
+            file_id = message.voice.file_id
+        else:
+            continue
+        telegram_files.set(remove_image_url_params(source), file_id)
+
+def is_on_domain(url: str, domain: str) -> bool:
+    """Whether url is on domain or one of its subdomains, lookalikes such as evil{domain} are not"""
+    hostname = urlparse(url).hostname or ''
+    return hostname == domain or hostname.endswith(f'.{domain}')
+
+async def get_redirected_url(url: str, max_hops: int = 5) -> str:
+    """Follow redirects only until they leave xhslink.com, without downloading any page"""
+    url = url if 'http' in url else f'http://{url}'
+    for _ in range(max_hops):
+        response = await http_get(url, follow_redirects=False)
+        if not response.has_redirect_location:
+            break
+        url = urljoin(url, response.headers['Location'])
+        if not is_on_domain(url, 'xhslink.com'):
+            break
+    return unquote(url.split("redirectPath=")[-1])
 
 def get_clean_url(url: str) -> str:
     return urljoin(url, urlparse(url).path)
@@ -766,83 +1748,207 @@ def remove_image_url_params(url: str) -> str:
         url = url.replace(f'&{k}={v[0]}', '')
     return url
 
+def telegraph_text(t: str) -> str:
+    """Whitespace collapsed the way Telegraph's HTML parser would"""
+    return ' '.join(t.split()) + (' ' if t[-1:].isspace() and t.strip() else '')
+
+def telegraph_node(tag: str, *children: Any, **attrs: str) -> dict[str, Any]:
+    node: dict[str, Any] = {'tag': tag}
+    if attrs:
+        node['attrs'] = attrs
+    children = tuple(child for child in children if child)
+    if children:
+        node['children'] = list(children)
+    return node
+
+# Every character MarkdownV2 reserves, backslash included, escaped in one pass
+markdown_v2_special = re.compile(r'([\\_*\[\]()~`>#+\-=|{}.!])')
+
 def tg_msg_escape_html(t: str) -> str:
-    return t.replace('<', '&lt;')\
-        .replace('>','&gt;')\
-        .replace('&', '&amp;')
+    # '&' first, so the entities produced for '<' and '>' are not escaped again
+    return t.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
 
 def tg_msg_escape_markdown_v2(t: str | int) -> str:
-    t = str(t)
-    for i in ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']:
-        t = t.replace(i, "\\" + i)
-    return t
+    return markdown_v2_special.sub(r'\\\1', str(t))
 
 def make_block_quotation(text: str) -> str:
-    lines = [f'>{tg_msg_escape_markdown_v2(line)}' for line in text.split('\n') if len(line) > 0 and bool(re.findall(r'\S+', line))]
+    lines = [f'>{tg_msg_escape_markdown_v2(line)}' for line in text.split('\n') if line and not line.isspace()]
     if len(lines) > 3:
         lines[0] = f'**{lines[0]}'
         lines[-1] = f'{lines[-1]}||'
     return '\n'.join(lines)
 
-def open_note(noteId: str, anchorCommentId: str | None = None) -> dict[str, Any] | None:
+async def open_note(noteId: str, anchorCommentId: str | None = None) -> dict[str, Any] | None:
     try:
-        return requests.get(f'https://{FLASK_SERVER_NAME}/open_note/{noteId}' + (f"?anchorCommentId={anchorCommentId}" if anchorCommentId else '')).json()
+        # The relay may queue the request until one of its devices is idle
+        return (await http_get(
+            f'https://{FLASK_SERVER_NAME}/open_note/{noteId}' + (f"?anchorCommentId={anchorCommentId}" if anchorCommentId else ''),
+            timeout=httpx.Timeout(10, read=60)
+        )).json()
     except:
         return None
 
-def get_url_info(message_text: str) -> dict[str, str | bool]:
-    xsec_token = ''
-    urls = re.findall(URL_REGEX, message_text)
-    bot_logger.info(f'URLs:\n{urls}')
-    anchorCommentId = ''
-    if len(urls) == 0:
-        bot_logger.debug("NO URL FOUND!")
-        return {'success': False, 'msg': 'No URL found in the message.', 'noteId': '', 'xsec_token': '', 'anchorCommentId': ''}
-    elif re.findall(r"[a-z0-9]{24}", message_text) and not re.findall(r"user/profile/[a-z0-9]{24}", message_text):
-        noteId = re.findall(r"[a-z0-9]{24}", message_text)[0]
-        note_url = [u for u in urls if re.findall(r"[a-z0-9]{24}", u) and not re.findall(r"user/profile/[a-z0-9]{24}", u)][0]
-        parsed_url = urlparse(str(note_url))
-        if 'xsec_token' in parse_qs(parsed_url.query):
-            xsec_token = parse_qs(parsed_url.query)['xsec_token'][0]
-        if 'anchorCommentId' in parse_qs(parsed_url.query):
-            anchorCommentId = parse_qs(parsed_url.query)['anchorCommentId'][0]
-    elif 'xhslink.com' in message_text or 'xiaohongshu.com' in message_text:
-        xhslink = [u for u in urls if 'xhslink.com' in u][0]
-        bot_logger.debug(f"URL found: {xhslink}")
-        redirectPath = get_redirected_url(xhslink)
-        bot_logger.debug(f"Redirected URL: {redirectPath}")
-        if re.findall(r"https?://(?:www.)?xhslink.com/[a-z]/[A-Za-z0-9]+", xhslink):
-            clean_url = get_clean_url(redirectPath)
-            if 'xiaohongshu.com/404' in redirectPath or 'xiaohongshu.com/login' in redirectPath:
-                noteId = re.findall(r"noteId=([a-z0-9]+)", redirectPath)[0]
-                if 'redirectPath=' in redirectPath:
-                    redirectPath = unquote(redirectPath.replace('https://www.xiaohongshu.com/login?redirectPath=', '').replace('https://www.xiaohongshu.com/404?redirectPath=', '').replace('https://www.xiaohongshu.com/login?redirectPath=', ''))
-            else:
-                noteId = re.findall(r"https?:\/\/(?:www.)?xiaohongshu.com\/discovery\/item\/([a-z0-9]+)", clean_url)[0]
-            parsed_url = urlparse(str(redirectPath))
-            if 'xsec_token' in parse_qs(parsed_url.query):
-                xsec_token = parse_qs(parsed_url.query)['xsec_token'][0]
-            if 'anchorCommentId' in parse_qs(parsed_url.query):
-                anchorCommentId = parse_qs(parsed_url.query)['anchorCommentId'][0]
-        elif re.findall(r"https?:\/\/(?:www.)?xiaohongshu.com\/discovery\/item\/[0-9a-z]+", xhslink):
-            noteId = re.findall(r"https?:\/\/(?:www.)?xiaohongshu.com\/discovery\/item\/([a-z0-9]+)", xhslink)[0]
-            parsed_url = urlparse(str(xhslink))
-            if 'xsec_token' in parse_qs(parsed_url.query):
-                xsec_token = parse_qs(parsed_url.query)['xsec_token'][0]
-            if 'anchorCommentId' in parse_qs(parsed_url.query):
-                anchorCommentId = parse_qs(parsed_url.query)['anchorCommentId'][0]
-        elif re.findall(r"https?://(?:www.)?xiaohongshu.com/explore/[a-z0-9]+", message_text):
-            noteId = re.findall(r"https?:\/\/(?:www.)?xiaohongshu.com\/explore\/([a-z0-9]+)", xhslink)[0]
-            parsed_url = urlparse(str(xhslink))
-            if 'xsec_token' in parse_qs(parsed_url.query):
-                xsec_token = parse_qs(parsed_url.query)['xsec_token'][0]
-            if 'anchorCommentId' in parse_qs(parsed_url.query):
-                anchorCommentId = parse_qs(parsed_url.query)['anchorCommentId'][0]
+async def get_capture(kind: str, noteId: str, timeout: float, min_version: int = 0) -> dict[str, Any]:
+    """Long-poll the relay for a capture newer than min_version, returns as soon as the device has captured it"""
+    response = await http_get(
+        f"https://{FLASK_SERVER_NAME}/get_{kind}/{noteId}",
+        params={'timeout': timeout, 'min_version': min_version},
+        timeout=httpx.Timeout(10, read=timeout + 10)
+    )
+    return response.json()
+
+async def fetch_note_data(noteId: str, anchorCommentId: str = '', timeout: float = capture_timeout) -> tuple[dict[str, Any], dict[str, Any]]:
+    """Open the note on device and wait for its note and comment list captures"""
+    note_data: dict[str, Any] = {}
+    comment_list_data: dict[str, Any] = {'data': {}}
+    opened = await open_note(noteId, anchorCommentId=anchorCommentId)
+    if not opened or opened.get('status') != 'success':
+        bot_logger.error(f'Failed to open note {noteId} on device: {opened}')
+        return note_data, comment_list_data
+    bot_logger.debug(f"Note {noteId} opened on device {opened.get('device', '')}")
+    # Captures left over from an earlier open of this note are skipped by the relay
+    versions: dict[str, int] = opened.get('versions', {})
+    try:
+        note_data = await get_capture('note', noteId, timeout, versions.get('note', 0))
+        if note_data:
+            capture_archive.add('note', noteId, note_data)
+        # Comments are captured right after the note, only give them a short grace period
+        # The relay times the poll out itself, a poll dropped by the bot would still consume a late capture
+        comment_list = await get_capture('comment_list', noteId, comment_list_grace if note_data else 0, versions.get('comment_list', 0))
+        if comment_list:
+            comment_list_data = comment_list
+            capture_archive.add('comment_list', noteId, comment_list_data)
+            bot_logger.debug('got comment list data')
         else:
-            return {'success': False, 'msg': 'Invalid URL or the note is no longer available.', 'noteId': '', 'xsec_token': ''}
+            bot_logger.warning(f'Comment list of note {noteId} was not captured in time')
+    except:
+        bot_logger.error(traceback.format_exc())
+    return note_data, comment_list_data
+
+async def get_note_data(noteId: str, anchorCommentId: str = '', with_xsec_token: bool = False, timeout: float = capture_timeout) -> tuple[dict[str, Any], dict[str, Any]]:
+    """Get note and comment list payloads, from the note cache when fresh or else from the device"""
+    cache_key = f'{noteId}.{"x" if with_xsec_token else "n"}.{anchorCommentId}'
+    cached = await note_cache.get(cache_key)
+    if cached:
+        bot_logger.debug(f'Note {noteId} served from cache')
+        return cached['note_data'], cached['comment_list_data']
+    note_data, comment_list_data = await fetch_note_data(noteId, anchorCommentId=anchorCommentId, timeout=timeout)
+    try:
+        # Only cache complete captures, a retry should get a chance to fetch missing comments
+        if note_data['data']['data'][0]['note_list'][0]['model_type'] != 'error' and comment_list_data.get('data'):
+            note_cache.set(cache_key, {'note_data': note_data, 'comment_list_data': comment_list_data})
+    except (KeyError, IndexError, TypeError):
+        pass
+    return note_data, comment_list_data
+
+async def build_note(noteId: str, xsec_token: str, anchorCommentId: str, with_xsec_token: bool) -> Note | None:
+    note_data, comment_list_data = await get_note_data(noteId, anchorCommentId=anchorCommentId, with_xsec_token=with_xsec_token)
+    if not note_data or 'data' not in note_data:
+        bot_logger.warning(f'Note data of {noteId} not captured')
+        return None
+    if note_data['data']['data'][0]['note_list'][0]['model_type'] == 'error':
+        bot_logger.warning(f'Note data not available\n{note_data['data']}')
+        return None
+    try:
+        await telegraph_account.get_account_info()  # type: ignore
+    except:
+        await telegraph_account.create_account( # type: ignore
+            short_name='@xhsfeedbot',
+        )
+    note = Note(
+        note_data['data'],
+        comment_list_data=comment_list_data['data'],
+        live=True,
+        telegraph=True,
+        with_xsec_token=with_xsec_token,
+        original_xsec_token=xsec_token,
+        telegraph_account=telegraph_account,
+        anchorCommentId=anchorCommentId
+    )
+    await note.initialize()
+    return note
+
+async def load_note(noteId: str, xsec_token: str = '', anchorCommentId: str = '', with_xsec_token: bool = False) -> Note | None:
+    """Get a parsed note with its Telegraph page, concurrent requests for the same note share a single fetch"""
+    key = f'{noteId}.{xsec_token if with_xsec_token else "n"}.{anchorCommentId}'
+    task = inflight_notes.get(key)
+    if task is None:
+        task = asyncio.create_task(build_note(noteId, xsec_token, anchorCommentId, with_xsec_token))
+        inflight_notes[key] = task
+        task.add_done_callback(lambda _: inflight_notes.pop(key, None))
     else:
-        return {'success': False, 'msg': 'Invalid URL.', 'noteId': '', 'xsec_token': ''}
-    return {'success': True, 'msg': 'Success.', 'noteId': noteId, 'xsec_token': xsec_token, 'anchorCommentId': anchorCommentId}
+        bot_logger.info(f'Note {noteId} is already being fetched, waiting for it')
+        record_metric('note.coalesced')
+    # Shielded so that one cancelled waiter does not cancel the fetch for the others
+    return await asyncio.shield(task)
+
+# XHS links in a message: one scan for the two domains, then only the matched spans are parsed
+xhs_link_pattern = re.compile(r"(xhslink|xiaohongshu)\.com(/[\w\-.~:/?#@!$&'*+,;=%]*)?", re.ASCII)
+note_id_pattern = re.compile(r'(?<![a-z0-9])[a-z0-9]{24}(?![a-z0-9])')
+
+def parse_note_link(path: str) -> dict[str, str] | None:
+    """noteId, xsec_token and anchorCommentId of a xiaohongshu.com note link, None for other pages"""
+    parsed_url = urlparse(path)
+    if parsed_url.path.startswith('/user/profile'):
+        return None
+    noteId = note_id_pattern.search(parsed_url.path)
+    if not noteId:
+        return None
+    query = parse_qs(parsed_url.query)
+    return {
+        'noteId': noteId.group(0),
+        'xsec_token': query.get('xsec_token', [''])[0],
+        'anchorCommentId': query.get('anchorCommentId', [''])[0],
+    }
+
+def extract_xhs_link(message_text: str) -> dict[str, str]:
+    """The first note link in a message, or else the first short link (as 'short_link') still to be resolved"""
+    short_link = ''
+    for match in xhs_link_pattern.finditer(message_text):
+        path = match.group(2) or ''
+        if match.group(1) == 'xiaohongshu':
+            note_link = parse_note_link(path)
+            if note_link:
+                return note_link
+        elif not short_link and len(path) > 1:
+            short_link = f'https://xhslink.com{path}'
+    return {'short_link': short_link} if short_link else {}
+
+async def get_url_info(message_text: str) -> dict[str, str | bool]:
+    link = extract_xhs_link(message_text)
+    bot_logger.info(f'XHS link:\n{link}')
+    if not link:
+        bot_logger.debug("NO XHS LINK FOUND!")
+        return {'success': False, 'msg': 'No XHS link found in the message.', 'noteId': '', 'xsec_token': '', 'anchorCommentId': ''}
+    if 'short_link' in link:
+        bot_logger.debug(f"URL found: {link['short_link']}")
+        short_code = urlparse(link['short_link']).path
+        resolved = await short_links.get(short_code)
+        if resolved is None:
+            resolved = await resolve_short_link(link['short_link'])
+            if not resolved:
+                return {'success': False, 'msg': 'Invalid URL or the note is no longer available.', 'noteId': '', 'xsec_token': '', 'anchorCommentId': ''}
+            short_links.set(short_code, resolved)
+        link = resolved
+    return {'success': True, 'msg': 'Success.', **link}
+
+async def resolve_short_link(short_link: str) -> dict[str, str] | None:
+    redirectPath = await get_redirected_url(short_link)
+    bot_logger.debug(f"Redirected URL: {redirectPath}")
+    if not is_on_domain(redirectPath, 'xiaohongshu.com'):
+        return None
+    resolved = parse_note_link(redirectPath)
+    if resolved:
+        return resolved
+    # 404 and login pages name the note in a noteId parameter
+    query = parse_qs(urlparse(redirectPath).query)
+    if 'noteId' not in query:
+        return None
+    return {
+        'noteId': query['noteId'][0],
+        'xsec_token': query.get('xsec_token', [''])[0],
+        'anchorCommentId': query.get('anchorCommentId', [''])[0],
+    }
 
 def parse_comment(comment_data: dict[str, Any]):
     target_comment = comment_data.get('target_comment', {})
@@ -853,6 +1959,7 @@ def parse_comment(comment_data: dict[str, Any]):
         r'\g<tag> ',
         content
     )
+    content = replace_redemoji_with_emoji(content)  # Once here, every renderer uses the parsed content
     pictures = comment_data.get('pictures', [])
     picture_urls: list[str] = []
     for p in pictures:
@@ -939,21 +2046,186 @@ def extract_all_comments(json_data: dict[str, Any]) -> list[dict[str, Any]]:
         data_parsed.append(parsed_comment)
     return data_parsed
 
-def convert_to_ogg_opus_pipe(input_bytes: bytes) -> bytes:
-    process = subprocess.Popen(
-        [
+async def convert_to_ogg_opus(input_bytes: bytes) -> bytes:
+    """Transcode through an ffmpeg pipe, at most FFMPEG_CONCURRENCY processes run at a time"""
+    async with ffmpeg_semaphore:
+        start_time = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
             "ffmpeg", "-i", "pipe:0",
             "-c:a", "libopus",
             "-f", "ogg",
-            "pipe:1"
-        ],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    out, _ = process.communicate(input_bytes)
+            "pipe:1",
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        try:
+            out, err = await process.communicate(input_bytes)
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        finally:
+            record_metric('ffmpeg.runs')
+            record_metric('ffmpeg.seconds', time.monotonic() - start_time)
+    if process.returncode != 0 or not out:
+        record_metric('ffmpeg.errors')
+        raise RuntimeError(f"ffmpeg exited with {process.returncode}: {err.decode(errors='replace')[-500:]}")
     return out
 
+# AI summaries: streamed into the reply message, edits coalesced to one per summary_edit_interval
+summary_edit_interval = float(os.getenv('SUMMARY_EDIT_INTERVAL', '1.5'))
+
+class MessageEditCoalescer:
+    """Keeps only the latest text pushed for a message and edits it in at most once per interval"""
+    def __init__(self, message: Message, interval: float = summary_edit_interval) -> None:
+        self.message = message
+        self.interval = interval
+        self.pending: str | None = None
+        self.last_text = ''
+        self.last_edit = 0.0
+        self.task: asyncio.Task[None] | None = None
+
+    def push(self, text: str) -> None:
+        self.pending = text
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self) -> None:
+        try:
+            # Text pushed while an edit was in flight is left for the next round
+            while self.pending is not None:
+                await self.flush()
+        except TelegramError as e:
+            bot_logger.warning(f"Failed to update message {self.message.message_id}: {e}")
+
+    async def flush(self) -> None:
+        await asyncio.sleep(max(0.0, self.last_edit + self.interval - time.monotonic()))
+        text, self.pending = self.pending, None
+        if text is None or text == self.last_text:
+            return
+        self.last_edit = time.monotonic()
+        try:
+            await self.message.edit_text(text=text, parse_mode=ParseMode.MARKDOWN_V2)
+        except RetryAfter as e:
+            # Flood control, hold the text back until the cooldown is over
+            retry_after = e.retry_after
+            self.last_edit = time.monotonic() + (retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after)
+            if self.pending is None:
+                self.pending = text
+            return
+        except BadRequest as e:
+            if 'not modified' not in str(e):
+                raise
+        self.last_text = text
+
+    async def close(self, text: str) -> None:
+        """Replace any scheduled edit with the final text"""
+        if self.task and not self.task.done():
+            self.task.cancel()
+        self.pending = text
+        while self.pending is not None:
+            await self.flush()
+
+def build_summary_query(note_content: str) -> str:
+    content_length = max(100, min(200, len(note_content)//2))
+    bot_logger.info(f"Generating summary with content length limit: {content_length}")
+    llm_query = f'''以下是一篇小红书笔记的完整内容。请先判断笔记本体的性质，再据此确定总结的语气与取向。
+
+【语气判断规则】
+1. 若笔记或评论呈现明显槽点、反差、搞笑情节、离谱行为、过度矫情、自我矛盾或"废物行为"（包括但不限于巨婴操作、反智自信、嘴硬硬撑、生活不自理等），可适度使用克制的幽默与轻度吐槽，但仅针对行为本身。
+2. 若槽点主体属于弱势群体（如老人、残障人士、认知障碍者等），即使行为可吐槽，也仅作客观、温和的事实描述。
+3. 若内容正常、信息性强、无槽点，则保持中立、简洁的分析风格。
+
+【多媒体处理原则】
+1. 若图片或视频对理解核心内容或槽点至关重要，则进行必要的简要概述。
+2. 若多媒体未提供新增信息，则直接忽略，不输出任何相关说明。
+
+【总结要求（需按顺序执行）】
+1. 完整概括笔记本体内容
+   - 必须体现主要内容、核心观点或意图。
+   - 如有槽点或亮点，可酌情补充。
+   - 若标签无实际信息或亮点，则不予概括。
+
+2. 单独概括评论区内容（如存在）
+   - 包括态度、补充信息、槽点或吐槽点。
+   - 不能以评论区代替笔记本体总结。
+
+3. 多媒体仅在必要时简要说明，不得机械复述画面。
+
+4. 语言自然、流畅。  
+5. 禁止输出无关内容。  
+6. 直接输出正文，无标题、无前后缀、无 Markdown。  
+7. 使用简体中文。
+8. 字数尽量不超过 {content_length}，若超出则在确保内容完整前提下尽量接近该限制。
+
+笔记内容如下：
+{note_content}'''
+    bot_logger.debug(f"LLM Query:\n{llm_query}")
+    return llm_query
+
+async def summary_image_part(media: dict[str, str]) -> types.Part:
+    """Image for the prompt, the derivative built when the note was sent if it is still around"""
+    path = media.get('file', '')
+    if path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            media_bytes = f.read()
+        record_metric('llm_media.ready')
+    else:
+        media_bytes = await fetch_media(media['url'])
+        try:
+            media_bytes = await build_llm_derivative(media['url'], media_bytes)
+        except Exception as e:
+            bot_logger.warning(f"Failed to compress image, using original: {e}")
+    return types.Part.from_bytes(
+        data=media_bytes,
+        mime_type="image/jpeg"
+    )
+
+async def stream_summary(ai_msg: Message, header: str, note_content: str, media_data: list[dict[str, str]]) -> str:
+    """Generate the AI summary of a note into ai_msg, the text shows up while it is being generated"""
+    summary_key = hashlib.sha256(json.dumps([note_content, media_data], ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+    cached_text: str | None = await summary_cache.get(summary_key)
+    if cached_text:
+        await ai_msg.edit_text(
+            text=f"{header}```Note\n{tg_msg_escape_markdown_v2(cached_text)}```",
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+        return cached_text
+    editor = MessageEditCoalescer(ai_msg)
+    status = lambda text: editor.push(f"{header}```\n{tg_msg_escape_markdown_v2(text)}```")
+    try:
+        status('Gathering note data...')
+        contents: list[types.Part] = [types.Part(text=build_summary_query(note_content))]
+
+        status('Downloading media...')
+        contents += await asyncio.gather(*(
+            summary_image_part(media) for media in media_data if media.get('type', '') == 'image' and 'url' in media
+        ))
+
+        status('Generating summary...')
+        start_time = time.monotonic()
+        text = ''
+        async for chunk in await client.aio.models.generate_content_stream(
+            model="gemini-2.5-flash",
+            contents=types.Content(parts=contents)
+        ):
+            if not chunk.text:
+                continue
+            if not text:
+                record_metric('summary.first_token_seconds', time.monotonic() - start_time)
+            text += chunk.text
+            editor.push(f"{header}```Note\n{tg_msg_escape_markdown_v2(text)} …```")
+        record_metric('summary.requests')
+        record_metric('summary.seconds', time.monotonic() - start_time)
+        if text:
+            summary_cache.set(summary_key, text)
+            await editor.close(f"{header}```Note\n{tg_msg_escape_markdown_v2(text)}```")
+        return text
+    finally:
+        if editor.task and not editor.task.done():
+            editor.task.cancel()
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id if update.effective_user else None
     chat = update.effective_chat
@@ -1010,6 +2282,24 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
             bot_logger.error(f"Failed to send help message: {e}")
             update_network_status(success=False)
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Report runtime metrics to the bot administrator"""
+    user_id = update.effective_user.id if update.effective_user else None
+    chat = update.effective_chat
+    if not chat or str(user_id) != os.getenv('ADMIN_ID'):
+        return
+    lines = [f'{name}: {value:.3f}'.rstrip('0').rstrip('.') for name, value in sorted(snapshot_metrics().items())]
+    try:
+        await context.bot.send_message(
+            chat_id=chat.id,
+            text='\n'.join(lines) if lines else 'No metrics recorded yet.',
+            disable_notification=True
+        )
+        update_network_status(success=True)
+    except Exception as e:
+        bot_logger.error(f"Failed to send stats message: {e}")
+        update_network_status(success=False)
+
 async def handle_message_reaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle message reactions for AI summary trigger"""
     bot_logger.debug(f"Received reaction update: {update}")
@@ -1049,9 +2339,13 @@ async def handle_message_reaction(update: Update, context: ContextTypes.DEFAULT_
     msg_identifier = f"{chat_id}.{message_id}"
     
     # Check if we have data for this message (verifies it's a bot message we processed)
-    msg_file_path = os.path.join('data', f'{msg_identifier}.json')
-    if not os.path.exists(msg_file_path):
-        bot_logger.debug(f"No data file found for message {msg_identifier}, ignoring reaction (not a bot-parsed message)")
+    try:
+        msg_data = await message_registry.get(chat_id, message_id)
+    except Exception as e:
+        bot_logger.error(f"Failed to read message data: {e}")
+        return
+    if msg_data is None:
+        bot_logger.debug(f"No data found for message {msg_identifier}, ignoring reaction (not a bot-parsed message)")
         return
     
     # React with 👾 (Alien Monster emoji)
@@ -1087,23 +2381,10 @@ async def handle_message_reaction(update: Update, context: ContextTypes.DEFAULT_
         bot_logger.error(f"Failed to send AI summary message: {e}")
         return
     
-    # Read the stored message data (we already verified it exists above)
-    try:
-        with open(msg_file_path, 'r', encoding='utf-8') as f:
-            msg_data = json.load(f)
-            note_content = msg_data.get('content', '')
-            media_data = msg_data.get('media', [])
-    except Exception as e:
-        bot_logger.error(f"Failed to read message data: {e}")
-        await asyncio.sleep(0.5)
-        await ai_msg.edit_text(
-            text=f"*{tg_msg_escape_markdown_v2('✨ AI Summary:')}*\n```\n{tg_msg_escape_markdown_v2('Error: Failed to load note data.')}```",
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        return
+    note_content = msg_data.get('content', '')
+    media_data = msg_data.get('media', [])
     
     if not note_content:
-        await asyncio.sleep(0.5)
         await ai_msg.edit_text(
             text=f"*{tg_msg_escape_markdown_v2('✨ AI Summary:')}*\n```\n{tg_msg_escape_markdown_v2('Error: Note content is empty.')}```",
             parse_mode=ParseMode.MARKDOWN_V2
@@ -1112,121 +2393,18 @@ async def handle_message_reaction(update: Update, context: ContextTypes.DEFAULT_
     
     # Generate AI summary
     try:
-        await asyncio.sleep(0.5)
-        await ai_msg.edit_text(
-            text=f"*{tg_msg_escape_markdown_v2('✨ AI Summary:')}*\n```\n{tg_msg_escape_markdown_v2('Gathering note data...')}```",
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        
-        content_length = max(100, min(200, len(note_content)//2))
-        llm_query = f'''以下是一篇小红书笔记的完整内容。请先判断笔记本体的性质，再据此确定总结的语气与取向。
-
-【语气判断规则】
-1. 若笔记或评论呈现明显槽点、反差、搞笑情节、离谱行为、过度矫情、自我矛盾或"废物行为"（包括但不限于巨婴操作、反智自信、嘴硬硬撑、生活不自理等），可适度使用克制的幽默与轻度吐槽，但仅针对行为本身。
-2. 若槽点主体属于弱势群体（如老人、残障人士、认知障碍者等），即使行为可吐槽，也仅作客观、温和的事实描述。
-3. 若内容正常、信息性强、无槽点，则保持中立、简洁的分析风格。
-
-【多媒体处理原则】
-1. 若图片或视频对理解核心内容或槽点至关重要，则进行必要的简要概述。
-2. 若多媒体未提供新增信息，则直接忽略，不输出任何相关说明。
-
-【总结要求（需按顺序执行）】
-1. 完整概括笔记本体内容
-   - 必须体现主要内容、核心观点或意图。
-   - 如有槽点或亮点，可酌情补充。
-   - 若标签无实际信息或亮点，则不予概括。
-
-2. 单独概括评论区内容（如存在）
-   - 包括态度、补充信息、槽点或吐槽点。
-   - 不能以评论区代替笔记本体总结。
-
-3. 多媒体仅在必要时简要说明，不得机械复述画面。
-
-4. 语言自然、流畅。  
-5. 禁止输出无关内容。  
-6. 直接输出正文，无标题、无前后缀、无 Markdown。  
-7. 使用简体中文。
-8. 字数尽量不超过 {content_length}，若超出则在确保内容完整前提下尽量接近该限制。
-
-笔记内容如下：
-{note_content}'''
-        
-        bot_logger.debug(f"LLM Query:\\n{llm_query}")
-        
-        contents: list[types.Part] = [types.Part(text=llm_query)]
-        
-        await asyncio.sleep(0.5)
-        await ai_msg.edit_text(
-            text=f"*{tg_msg_escape_markdown_v2('✨ AI Summary:')}*\n```\n{tg_msg_escape_markdown_v2('Downloading media...')}```",
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        
-        # Download media and convert to Gemini Part
-        for media in media_data:
-            if media.get('type', '') == 'image' and 'url' in media:
-                media_url = media['url']
-                media_bytes = requests.get(media_url).content
-                
-                # Compress image to 720p before uploading to Gemini
-                try:
-                    img = Image.open(BytesIO(media_bytes))
-                    # Calculate new size while maintaining aspect ratio
-                    width, height = img.size
-                    if height > 720 or width > 1280:
-                        if height > width:
-                            new_height = 720
-                            new_width = int(width * (720 / height))
-                        else:
-                            new_width = 1280
-                            new_height = int(height * (1280 / width))
-                        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                    
-                    # Convert to JPEG and compress
-                    output = BytesIO()
-                    img.convert('RGB').save(output, format='JPEG', quality=70, optimize=True)
-                    media_bytes = output.getvalue()
-                    bot_logger.debug(f"Compressed image from {width}x{height} to {img.size[0]}x{img.size[1]}")
-                except Exception as e:
-                    bot_logger.warning(f"Failed to compress image, using original: {e}")
-                
-                image_part = types.Part.from_bytes(
-                    data=media_bytes,
-                    mime_type="image/jpeg"
-                )
-                contents.append(image_part)
-        
-        bot_logger.info(f"Generating summary with content length limit: {content_length}")
-        await asyncio.sleep(0.5)
-        await ai_msg.edit_text(
-            text=f"*{tg_msg_escape_markdown_v2('✨ AI Summary:')}*\n```\n{tg_msg_escape_markdown_v2('Generating summary...')}```",
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=types.Content(parts=contents)
-        )
-        text = response.text
+        text = await stream_summary(ai_msg, f"*{tg_msg_escape_markdown_v2('✨ AI Summary:')}*\n", note_content, media_data)
         bot_logger.info(f"Generated summary:\\n{text}")
         
-        if not response or not text:
+        if not text:
             bot_logger.error("No response from Gemini API")
-            await asyncio.sleep(0.5)
             await ai_msg.edit_text(
                 text=f"*{tg_msg_escape_markdown_v2('✨ AI Summary:')}*\n```\n{tg_msg_escape_markdown_v2('Error: No response from AI service.')}```",
                 parse_mode=ParseMode.MARKDOWN_V2
             )
-            return
-        
-        await asyncio.sleep(0.5)
-        await ai_msg.edit_text(
-            text=f"*{tg_msg_escape_markdown_v2('✨ AI Summary:')}*\n```Note\n{tg_msg_escape_markdown_v2(text)}```",
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
     except Exception as e:
         bot_logger.error(f"Error generating AI summary: {e}\\n{traceback.format_exc()}")
         try:
-            await asyncio.sleep(0.5)
             await ai_msg.edit_text(
                 text=f"*{tg_msg_escape_markdown_v2('✨ AI Summary:')}*\n```\n{tg_msg_escape_markdown_v2(f'Error: {str(e)}')}```",
                 parse_mode=ParseMode.MARKDOWN_V2
@@ -1273,17 +2451,12 @@ async def AI_summary_button_callback(update: Update, context: ContextTypes.DEFAU
             action=ChatAction.TYPING
         )
         
-        # Add delay before editing message
-        await asyncio.sleep(0.5)
-        
         await context.bot.edit_message_reply_markup(
             chat_id=chat_id,
             message_id=int(msg_identifier.split(".")[-1]),
             reply_markup=None
         )
         
-        # Add delay before sending new message
-        await asyncio.sleep(0.5)
         ai_msg = await context.bot.send_message(
             chat_id=chat_id,
             reply_to_message_id=int(msg_identifier.split(".")[-1]),
@@ -1295,115 +2468,19 @@ async def AI_summary_button_callback(update: Update, context: ContextTypes.DEFAU
         # Read the stored message string if available
         note_content = ''
         media_data: list[dict[str, str]] = []
-        msg_file_path = os.path.join('data', f'{msg_identifier}.json')
-        if os.path.exists(msg_file_path):
-            with open(msg_file_path, 'r', encoding='utf-8') as f:
-                msg_data = json.load(f)
-                note_content = msg_data.get('content', '')
-                media_data = msg_data.get('media', [])
-                f.close()
-            # Delete file after reading
-            os.remove(msg_file_path)
+        msg_chat_id, msg_id = (int(part) for part in msg_identifier.split("."))
+        msg_data = await message_registry.get(msg_chat_id, msg_id)
+        if msg_data is not None:
+            note_content = msg_data.get('content', '')
+            media_data = msg_data.get('media', [])
+            # Forget the message after reading
+            message_registry.delete(msg_chat_id, msg_id)
         if not note_content or not media_data:
             return
-        await ai_msg.edit_text(
-            text=f"*_{tg_msg_escape_markdown_v2('✨ AI Summary:\n')}_*```\n{tg_msg_escape_markdown_v2('Gathering note data...')}```",
-            parse_mode=ParseMode.MARKDOWN_V2,
-        )
-
-        content_length = max(100, min(200, len(note_content)//2))
-        llm_query: str = f'''以下是一篇小红书笔记的完整内容。请先判断笔记本体的性质，再据此确定总结的语气与取向。
-
-【语气判断规则】
-1. 若笔记或评论呈现明显槽点、反差、搞笑情节、离谱行为、过度矫情、自我矛盾或“废物行为”（包括但不限于巨婴操作、反智自信、嘴硬硬撑、生活不自理等），可适度使用克制的幽默与轻度吐槽，但仅针对行为本身。
-2. 若槽点主体属于弱势群体（如老人、残障人士、认知障碍者等），即使行为可吐槽，也仅作客观、温和的事实描述。
-3. 若内容正常、信息性强、无槽点，则保持中立、简洁的分析风格。
-
-【多媒体处理原则】
-1. 若图片或视频对理解核心内容或槽点至关重要，则进行必要的简要概述。
-2. 若多媒体未提供新增信息，则直接忽略，不输出任何相关说明。
-
-【总结要求（需按顺序执行）】
-1. 完整概括笔记本体内容
-   - 必须体现主要内容、核心观点或意图。
-   - 如有槽点或亮点，可酌情补充。
-   - 若标签无实际信息或亮点，则不予概括。
-
-2. 单独概括评论区内容（如存在）
-   - 包括态度、补充信息、槽点或吐槽点。
-   - 不能以评论区代替笔记本体总结。
-
-3. 多媒体仅在必要时简要说明，不得机械复述画面。
-
-4. 语言自然、流畅。  
-5. 禁止输出无关内容。  
-6. 直接输出正文，无标题、无前后缀、无 Markdown。  
-7. 使用简体中文。
-8. 字数尽量不超过 {content_length}，若超出则在确保内容完整前提下尽量接近该限制。
-
-笔记内容如下：
-{note_content}'''
-        bot_logger.debug(f"LLM Query:\n{llm_query}")
-
-        contents: list[types.Part] = [
-            types.Part(text=llm_query)
-        ]
-        await ai_msg.edit_text(
-            text=f"*_{tg_msg_escape_markdown_v2('✨ AI Summary:\n')}_*```\n{tg_msg_escape_markdown_v2('Downloading media...')}```",
-            parse_mode=ParseMode.MARKDOWN_V2,
-        )
-        # download media and convert to Gemini Part
-        for media in media_data:
-            if media.get('type', '') == 'image' and 'url' in media:
-                media_url = media['url']
-                media_bytes = requests.get(media_url).content
-                
-                # Compress image to 720p before uploading to Gemini
-                try:
-                    img = Image.open(BytesIO(media_bytes))
-                    # Calculate new size while maintaining aspect ratio
-                    width, height = img.size
-                    if height > 720 or width > 1280:
-                        if height > width:
-                            new_height = 720
-                            new_width = int(width * (720 / height))
-                        else:
-                            new_width = 1280
-                            new_height = int(height * (1280 / width))
-                        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                    
-                    # Convert to JPEG and compress
-                    output = BytesIO()
-                    img.convert('RGB').save(output, format='JPEG', quality=70, optimize=True)
-                    media_bytes = output.getvalue()
-                    bot_logger.debug(f"Compressed image from {width}x{height} to {img.size[0]}x{img.size[1]}")
-                except Exception as e:
-                    bot_logger.warning(f"Failed to compress image, using original: {e}")
-                
-                image_part = types.Part.from_bytes(
-                    data=media_bytes,
-                    mime_type="image/jpeg"
-                )
-                contents.append(image_part)
-
-        bot_logger.info(f"Generating summary with content length limit: {content_length}")
-        await ai_msg.edit_text(
-            text=f"*_{tg_msg_escape_markdown_v2('✨ AI Summary:\n')}_*```\n{tg_msg_escape_markdown_v2('Generating summary...')}```",
-            parse_mode=ParseMode.MARKDOWN_V2,
-        )
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=types.Content(parts=contents),
-        )
-        text = response.text
+        text = await stream_summary(ai_msg, f"*_{tg_msg_escape_markdown_v2('✨ AI Summary:\n')}_*", note_content, media_data)
         bot_logger.info(f"Generated summary for note {noteId}:\n{text}")
-        if not response or not text:
+        if not text:
             bot_logger.error("No response from Gemini API")
-            return
-        await ai_msg.edit_text(
-            text=f"*_{tg_msg_escape_markdown_v2('✨ AI Summary:\n')}_*```Note\n{tg_msg_escape_markdown_v2(text)}```",
-            parse_mode=ParseMode.MARKDOWN_V2,
-        )
     except Exception as e:
         bot_logger.error(f"Error in button callback: {e}\n{traceback.format_exc()}")
         if query.message:
@@ -1476,7 +2553,7 @@ async def _note2feed_internal(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not await is_user_whitelisted(user_id, context.bot):
         bot_logger.warning(f"Unauthorized access attempt from user {user_id}")
         with_xsec_token = bool(re.search(r"[^\S]+-x(?!\S)", message_text))
-        url_info = get_url_info(message_text)
+        url_info = await get_url_info(message_text)
         if not url_info['success']:
             return
         noteId = str(url_info['noteId'])
@@ -1518,7 +2595,7 @@ async def _note2feed_internal(update: Update, context: ContextTypes.DEFAULT_TYPE
             bot_logger.error(f"Failed to decode QR code: {e}")
 
     with_xsec_token = bool(re.search(r"[^\S]+-x(?!\S)", message_text))
-    url_info = get_url_info(message_text)
+    url_info = await get_url_info(message_text)
     if not url_info['success']:
         return
     noteId = str(url_info['noteId'])
@@ -1527,73 +2604,15 @@ async def _note2feed_internal(update: Update, context: ContextTypes.DEFAULT_TYPE
     bot_logger.info(f'Note ID: {noteId}, xsec_token: {xsec_token if xsec_token else "None"}, anchorCommentId: {anchorCommentId if anchorCommentId else "None"}')
 
     bot_logger.debug('try open note on device')
-    open_note(noteId, anchorCommentId=anchorCommentId)
-    await asyncio.sleep(1.5)
-
-    note_data: dict[str, Any] = {}
-    comment_list_data: dict[str, Any] = {'data': {}}
-
     try:
-        note_data = requests.get(
-            f"https://{FLASK_SERVER_NAME}/get_note/{noteId}"
-        ).json()
-        with open(os.path.join("data", f"note_data-{noteId}.json"), "w", encoding='utf-8') as f:
-            json.dump(note_data, f, indent=4, ensure_ascii=False)
-            f.close()
-        times = 0
-        while True:
-            times += 1
-            try:
-                comment_list_data = requests.get(
-                    f"https://{FLASK_SERVER_NAME}/get_comment_list/{noteId}"
-                ).json()
-                with open(os.path.join("data", f"comment_list_data-{noteId}.json"), "w", encoding='utf-8') as f:
-                    json.dump(comment_list_data, f, indent=4, ensure_ascii=False)
-                    f.close()
-                bot_logger.debug('got comment list data')
-                break
-            except:
-                if times <= 3:
-                    await asyncio.sleep(0.1)
-                else:
-                    raise Exception('error when getting comment list data')
-    except:
-        bot_logger.error(traceback.format_exc())
-    finally:
-        if not note_data or 'data' not in note_data:
+        note = await load_note(noteId, xsec_token=xsec_token, anchorCommentId=anchorCommentId, with_xsec_token=with_xsec_token)
+        if note is None:
             # React with tear emoji if note data is not available
             try:
                 await msg.set_reaction("😢")
             except Exception as e:
                 bot_logger.debug(f"Failed to set tear reaction: {e}")
             return
-    if note_data['data']['data'][0]['note_list'][0]['model_type'] == 'error':
-        bot_logger.warning(f'Note data not available\n{note_data['data']}')
-        # React with tear emoji if note model type is error
-        try:
-            await msg.set_reaction("😢")
-        except Exception as e:
-            bot_logger.debug(f"Failed to set tear reaction: {e}")
-        return
-
-    try:
-        try:
-            await telegraph_account.get_account_info()  # type: ignore
-        except:
-            await telegraph_account.create_account( # type: ignore
-                short_name='@xhsfeedbot',
-            )
-        note = Note(
-            note_data['data'],
-            comment_list_data=comment_list_data['data'],
-            live=True,
-            telegraph=True,
-            with_xsec_token=with_xsec_token,
-            original_xsec_token=xsec_token,
-            telegraph_account=telegraph_account,
-            anchorCommentId=anchorCommentId
-        )
-        await note.initialize()
         try:
             # reply with rich text when sending media failed
             await context.bot.send_chat_action(
@@ -1618,15 +2637,11 @@ async def _note2feed_internal(update: Update, context: ContextTypes.DEFAULT_TYPE
             
             # Store note data for telegraph message to enable AI summary on reaction
             try:
-                telegraph_msg_identifier = f"{chat.id}.{telegraph_msg.message_id}"
-                msg_data = {
+                message_registry.put(chat.id, telegraph_msg.message_id, {
                     'content': str(note),
                     'media': note.media_for_llm()
-                }
-                telegraph_msg_file_path = os.path.join('data', f'{telegraph_msg_identifier}.json')
-                with open(telegraph_msg_file_path, 'w', encoding='utf-8') as f:
-                    json.dump(msg_data, f, ensure_ascii=False, indent=2)
-                bot_logger.debug(f"Saved telegraph message data to {telegraph_msg_file_path} for AI summary")
+                })
+                bot_logger.debug(f"Registered telegraph message {chat.id}.{telegraph_msg.message_id} for AI summary")
             except Exception as e:
                 bot_logger.error(f"Failed to save telegraph message data: {e}")
             
@@ -1698,7 +2713,7 @@ async def _inline_note2feed_internal(update: Update, context: ContextTypes.DEFAU
     
 
     with_xsec_token = bool(re.search(r"[^\S]+-x(?!\S)", message_text))
-    url_info = get_url_info(message_text)
+    url_info = await get_url_info(message_text)
     if not url_info['success']:
         return
     noteId = str(url_info['noteId'])
@@ -1731,62 +2746,10 @@ async def _inline_note2feed_internal(update: Update, context: ContextTypes.DEFAU
         return
 
     bot_logger.debug('try open note on device')
-    open_note(noteId, anchorCommentId=anchorCommentId)
-    await asyncio.sleep(3)
-
-    note_data: dict[str, Any] = {}
-    comment_list_data: dict[str, Any] = {'data': {}}
-
     try:
-        note_data = requests.get(
-            f"https://{FLASK_SERVER_NAME}/get_note/{noteId}"
-        ).json()
-        with open(os.path.join("data", f"note_data-{noteId}.json"), "w", encoding='utf-8') as f:
-            json.dump(note_data, f, indent=4, ensure_ascii=False)
-            f.close()
-        times = 0
-        while True:
-            times += 1
-            try:
-                comment_list_data = requests.get(
-                    f"https://{FLASK_SERVER_NAME}/get_comment_list/{noteId}"
-                ).json()
-                with open(os.path.join("data", f"comment_list_data-{noteId}.json"), "w", encoding='utf-8') as f:
-                    json.dump(comment_list_data, f, indent=4, ensure_ascii=False)
-                    f.close()
-                bot_logger.debug('got comment list data')
-                break
-            except:
-                if times <= 3:
-                    await asyncio.sleep(0.1)
-                else:
-                    raise Exception('error when getting comment list data')
-    except:
-        bot_logger.error(traceback.format_exc())
-    finally:
-        if not note_data or 'data' not in note_data:
+        note = await load_note(noteId, xsec_token=xsec_token, anchorCommentId=anchorCommentId, with_xsec_token=with_xsec_token)
+        if note is None:
             return
-    if note_data['data']['data'][0]['note_list'][0]['model_type'] == 'error':
-        bot_logger.warning(f'Note data not available\n{note_data["data"]}')
-        return
-    try:
-        try:
-            await telegraph_account.get_account_info()  # type: ignore
-        except:
-            await telegraph_account.create_account( # type: ignore
-                short_name='@xhsfeedbot',
-            )
-        note = Note(
-            note_data['data'],
-            comment_list_data=comment_list_data['data'],
-            live=True,
-            telegraph=True,
-            with_xsec_token=with_xsec_token,
-            original_xsec_token=xsec_token,
-            telegraph_account=telegraph_account,
-            anchorCommentId=anchorCommentId
-        )
-        await note.initialize()
         telegraph_url = note.telegraph_url if hasattr(note, 'telegraph_url') else await note.to_telegraph()
         inline_query_result = [
             InlineQueryResultArticle(
@@ -1823,7 +2786,7 @@ async def error_handler(update: Any, context: ContextTypes.DEFAULT_TYPE) -> None
     # Check for pool timeout - this is critical and should trigger immediate restart
     if 'pool timeout' in error_str or 'all connections in the connection pool are occupied' in error_str:
         bot_logger.error(f"CRITICAL: Pool timeout detected - triggering immediate restart:\n{context.error}")
-        bark_notify("xhsfeedbot: Pool timeout detected, restarting immediately")
+        await bark_notify("xhsfeedbot: Pool timeout detected, restarting immediately")
         restart_script()
         return
     
@@ -1836,7 +2799,7 @@ async def error_handler(update: Any, context: ContextTypes.DEFAULT_TYPE) -> None
     if isinstance(context.error, NetworkError) or any(keyword in error_str for keyword in network_keywords):
         bot_logger.error(f"Network-related error detected:\n{context.error}\n\n{traceback.format_exc()}")
         update_network_status(success=False)
-        if not is_network_healthy or not check_network_connectivity():
+        if not is_network_healthy or not await check_network_connectivity():
             bot_logger.error("Network appears unhealthy - triggering restart")
             restart_script()
         return
@@ -1867,6 +2830,8 @@ def run_telegram_bot():
     if not bot_token:
         raise ValueError("BOT_TOKEN environment variable is required")
     
+    open_storage()
+
     # Start network monitoring in background thread
     monitor_thread = threading.Thread(target=network_monitor, daemon=True)
     monitor_thread.start()
@@ -1885,14 +2850,17 @@ def run_telegram_bot():
         .pool_timeout(20)\
         .connection_pool_size(16)\
         .concurrent_updates(True)\
+        .post_shutdown(post_shutdown)\
         .build()
 
-    bark_notify("xhsfeedbot tries to start polling.")
+    bark_notify_sync("xhsfeedbot tries to start polling.")
     try:
         start_handler = CommandHandler("start", start)
         application.add_handler(start_handler)
         help_handler = CommandHandler("help", help)
         application.add_handler(help_handler)
+        stats_handler = CommandHandler("stats", stats)
+        application.add_handler(stats_handler)
         
         # AI summary button callback handler disabled
         # AI_summary_button_callback_handler = CallbackQueryHandler(AI_summary_button_callback)
@@ -1944,7 +2912,7 @@ def run_telegram_bot():
     except NetworkError as e:
         bot_logger.error(f'NetworkError: {e}\n{traceback.format_exc()}')
         update_network_status(success=False)
-        if not check_network_connectivity():
+        if not check_network_connectivity_sync():
             bot_logger.error('Network connectivity test failed - restarting')
             restart_script()
         raise Exception('NetworkError received, script will quit now.')
@@ -1955,79 +2923,92 @@ def run_telegram_bot():
         if any(keyword in error_str for keyword in network_keywords):
             bot_logger.error(f'Network-related error in main loop: {e}\n{traceback.format_exc()}')
             update_network_status(success=False)
-            if not check_network_connectivity():
+            if not check_network_connectivity_sync():
                 bot_logger.error('Network connectivity test failed - restarting')
                 restart_script()
         else:
             bot_logger.error(f'Unexpected error:\n{traceback.format_exc()}\n\n SCRIPT WILL QUIT NOW')
         raise Exception(f'Error in main loop: {e}')
 
-def bark_notify(message: str) -> None:
+def bark_request(message: str) -> dict[str, Any] | None:
+    """Method, URL and form data of the Bark notification for message, None if Bark is not configured"""
     bark_token = os.getenv('BARK_TOKEN')
     bark_key = os.getenv('BARK_KEY')  # 32-character encryption key
     bark_iv = os.getenv('BARK_IV', '472')  # IV, default to '472'
     
     if not bark_token:
         bot_logger.warning('BARK_TOKEN not set, cannot send bark notification')
-        return
+        return None
     
+    plain_request = {'method': 'GET', 'url': f'https://api.day.app/{bark_token}/{quote("xhsfeedbot")}/{quote(message)}'}
+    # If encryption key is provided, send encrypted notification
+    if not bark_key:
+        return plain_request
+    
+    # Ensure key is 32 bytes (256 bits for AES-256)
+    if len(bark_key) != 32:
+        bot_logger.error(f'BARK_KEY must be exactly 32 characters long, got {len(bark_key)}')
+        # Fall back to unencrypted
+        return plain_request
+    
+    # Create JSON payload
+    payload = json.dumps({
+        "body": message,
+        "sound": "birdsong",
+        "title": "xhsfeedbot"
+    }, ensure_ascii=False)
+    
+    # Encrypt using AES-256-ECB with PKCS7 padding
+    # ECB mode doesn't use IV, so we ignore the bark_iv parameter for encryption
+    cipher = AES.new(bark_key.encode('utf-8'), AES.MODE_ECB)  # pyright: ignore[reportUnknownMemberType]
+    encrypted = cipher.encrypt(pad(payload.encode('utf-8'), AES.block_size))
+    
+    # Base64 encode the ciphertext
+    ciphertext = base64.b64encode(encrypted).decode('utf-8')
+    return {
+        'method': 'POST',
+        'url': f'https://api.day.app/{bark_token}',
+        'data': {
+            'ciphertext': ciphertext,
+            'iv': bark_iv
+        }
+    }
+
+async def bark_notify(message: str) -> None:
     try:
-        # If encryption key is provided, send encrypted notification
-        if bark_key:
-            # Create JSON payload
-            payload = json.dumps({
-                "body": message,
-                "sound": "birdsong",
-                "title": "xhsfeedbot"
-            }, ensure_ascii=False)
-            
-            # Ensure key is 32 bytes (256 bits for AES-256)
-            if len(bark_key) != 32:
-                bot_logger.error(f'BARK_KEY must be exactly 32 characters long, got {len(bark_key)}')
-                # Fall back to unencrypted
-                requests.get(
-                    f'https://api.day.app/{bark_token}/{quote("xhsfeedbot")}/{quote(message)}'
-                )
-                return
-            
-            # Convert key to bytes
-            key_bytes = bark_key.encode('utf-8')
-            
-            # Encrypt using AES-256-ECB with PKCS7 padding
-            # ECB mode doesn't use IV, so we ignore the bark_iv parameter for encryption
-            cipher = AES.new(key_bytes, AES.MODE_ECB)  # pyright: ignore[reportUnknownMemberType]
-            encrypted = cipher.encrypt(pad(payload.encode('utf-8'), AES.block_size))
-            
-            # Base64 encode the ciphertext
-            ciphertext = base64.b64encode(encrypted).decode('utf-8')
-            
-            # Send encrypted notification
-            response = requests.post(
-                f'https://api.day.app/{bark_token}',
-                data={
-                    'ciphertext': ciphertext,
-                    'iv': bark_iv
-                }
-            )
-            
-            if response.status_code == 200:
-                bot_logger.info('Encrypted Bark notification sent successfully')
-            else:
-                bot_logger.error(f'Failed to send encrypted bark notification: {response.status_code} {response.text}')
+        bark = bark_request(message)
+        if bark is None:
+            return
+        response = await http_request(bark['method'], bark['url'], data=bark.get('data'), timeout=10)
+        if response.status_code == 200:
+            bot_logger.info('Bark notification sent successfully')
         else:
-            # Send unencrypted notification (original behavior)
-            requests.get(
-                f'https://api.day.app/{bark_token}/{quote("xhsfeedbot")}/{quote(message)}'
-            )
+            bot_logger.error(f'Failed to send bark notification: {response.status_code} {response.text}')
+    except Exception as e:
+        bot_logger.error(f'Failed to send bark notification: {e}\n{traceback.format_exc()}')
+
+def bark_notify_sync(message: str) -> None:
+    """Blocking bark_notify, only for the monitor threads and for code running outside the event loop"""
+    try:
+        bark = bark_request(message)
+        if bark is None:
+            return
+        response = requests.request(bark['method'], bark['url'], data=bark.get('data'), timeout=10)
+        if response.status_code == 200:
             bot_logger.info('Bark notification sent successfully')
-            
+        else:
+            bot_logger.error(f'Failed to send bark notification: {response.status_code} {response.text}')
     except Exception as e:
         bot_logger.error(f'Failed to send bark notification: {e}\n{traceback.format_exc()}')
 
 def restart_script():
     bot_logger.info("Restarting script...")
     # notify bot owner with bark
-    bark_notify("xhsfeedbot is restarting due to network issues.")
+    bark_notify_sync("xhsfeedbot is restarting due to network issues.")
+    try:
+        close_storage()
+    except Exception as e:
+        bot_logger.error(f'Error when flushing storage: {e}\n{traceback.format_exc()}')
     try:
         process = psutil.Process(os.getpid())
         for handler in process.open_files() + process.net_connections():
@@ -2039,7 +3020,7 @@ def restart_script():
 
 if __name__ == "__main__":
     try:
-        telegraph_account = Telegraph()
+        telegraph_account = Telegraph(access_token=os.getenv('TELEGRAPH_ACCESS_TOKEN') or None)
         client = genai.Client()
         run_telegram_bot()
     except Exception as e: